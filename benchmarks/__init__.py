@@ -0,0 +1,4 @@
+'''
+Benchmarks for nestedaaddb.
+Run a benchmark from the repository root, e.g. python -m benchmarks.bench_membership_diff
+'''
@@ -0,0 +1,83 @@
+'''
+Benchmark of the logging cost of the membership diff, with per-member tracing off and on.
+Every group gets its diff computed and its summary logged the way the plan does it.
+The root logger is at DEBUG and writes to /dev/null, so the traced run pays for formatting and writing every record
+'''
+import argparse
+import logging
+import os
+import time
+
+from nestedaaddb.databricks_directory import DatabricksDirectory
+from nestedaaddb.membership_graph import MembershipGraph
+from nestedaaddb.membership_diff import compute_membership_diff, summarize_membership_diff, log_membership_diff
+
+
+class CountingHandler(logging.StreamHandler):
+
+    def __init__(self, stream):
+        super().__init__(stream)
+        self.records = 0
+
+    def emit(self, record):
+        self.records += 1
+        super().emit(record)
+
+
+'''
+groups groups of size members each, a tenth of the AAD members are missing in Databricks
+and a tenth of the Databricks members are stale
+'''
+
+
+def build_tenant(groups, size):
+    drift = max(1, size // 10)
+
+    graph = MembershipGraph()
+    dbusers = [{"id": str(i), "userName": f"USER{i}@example.com"} for i in range(size + drift)]
+    dbgroups = []
+    for g in range(groups):
+        name = f"Group {g}"
+        graph.add_members(name, [graph.user(f"User {i}", f"user{i}@example.com") for i in range(size)])
+        dbgroups.append({
+            "id": f"g{g}",
+            "displayName": name,
+            "members": [{"value": str(i), "display": f"User {i}", "$ref": f"Users/{i}"}
+                        for i in range(drift, size + drift)]
+        })
+
+    return graph, dbgroups, DatabricksDirectory(dbusers, dbgroups)
+
+
+def run_diff(graph, dbgroups, directory, trace):
+    for dbg in dbgroups:
+        toadd, toremove = compute_membership_diff(graph.get(dbg["displayName"]), dbg, directory, trace)
+        if toadd or toremove:
+            log_membership_diff(summarize_membership_diff(dbg["displayName"], toadd, toremove))
+
+
+def run(groups, size):
+    graph, dbgroups, directory = build_tenant(groups, size)
+
+    with open(os.devnull, "w") as devnull:
+        handler = CountingHandler(devnull)
+        handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(message)s"))
+        root = logging.getLogger()
+        root.handlers = [handler]
+        root.setLevel(logging.DEBUG)
+
+        for trace in (False, True):
+            handler.records = 0
+            start = time.perf_counter()
+            run_diff(graph, dbgroups, directory, trace)
+            elapsed = time.perf_counter() - start
+            print(f"groups={groups} members={size} trace={'on ' if trace else 'off'} "
+                  f"records={handler.records:>8} time={elapsed:.3f}s")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--groups", type=int, default=200)
+    parser.add_argument("--members", type=int, default=5000)
+    args = parser.parse_args()
+    run(args.groups, args.members)
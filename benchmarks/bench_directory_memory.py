@@ -0,0 +1,121 @@
+'''
+Peak memory of reading the Databricks directory with the list readers (full resources, everything kept
+in lists) compared to the streaming readers (projected attributes consumed straight into the index).
+SCIM pages are generated as JSON text so decoding costs are included, no network is involved.
+
+python -m benchmarks.bench_directory_memory --users 50000 --groups 2000 --members 200
+'''
+import argparse
+import json
+import random
+import tracemalloc
+
+from nestedaaddb.databricks_client import PAGE_SIZE
+from nestedaaddb.databricks_directory import DatabricksDirectory
+
+
+def full_user(i, group_ids):
+    return {
+        "schemas": ["urn:ietf:params:scim:schemas:core:2.0:User"],
+        "id": str(1000000 + i),
+        "userName": f"user{i}@example.com",
+        "displayName": f"User {i}",
+        "name": {"givenName": "User", "familyName": str(i)},
+        "emails": [{"value": f"user{i}@example.com", "type": "work", "primary": True}],
+        "active": True,
+        "groups": [{"display": f"Group {g}", "value": str(g), "$ref": f"Groups/{g}", "type": "direct"}
+                   for g in group_ids],
+        "entitlements": [{"value": "workspace-access"}, {"value": "databricks-sql-access"}]
+    }
+
+
+def full_group(g, member_ids):
+    return {
+        "schemas": ["urn:ietf:params:scim:schemas:core:2.0:Group"],
+        "id": str(g),
+        "displayName": f"Group {g}",
+        "members": [{"display": f"User {m}", "value": str(1000000 + m), "$ref": f"Users/{1000000 + m}"}
+                    for m in member_ids],
+        "meta": {"resourceType": "Group"},
+        "entitlements": [{"value": "workspace-access"}],
+        "roles": [],
+        "groups": []
+    }
+
+
+def project(resource, attributes):
+    return {k: v for k, v in resource.items() if k in attributes}
+
+
+'''
+Yield the JSON text of every SCIM page, as the service would send it
+'''
+
+
+def scim_pages(resources, attributes=None):
+    for start in range(0, len(resources), PAGE_SIZE):
+        page = resources[start:start + PAGE_SIZE]
+        if attributes:
+            page = [project(r, attributes) for r in page]
+        yield json.dumps({"totalResults": len(resources), "startIndex": start + 1, "Resources": page})
+
+
+def list_readers(users, groups):
+    dbusers = []
+    for text in scim_pages(users):
+        dbusers.extend(json.loads(text)["Resources"])
+    dbgroups = []
+    for text in scim_pages(groups):
+        dbgroups.extend(json.loads(text)["Resources"])
+    directory = DatabricksDirectory(dbusers, dbgroups)
+    return directory, dbusers, dbgroups
+
+
+def streaming_readers(users, groups):
+    directory = DatabricksDirectory([], [])
+    for text in scim_pages(users, {"id", "userName"}):
+        for dbu in json.loads(text)["Resources"]:
+            directory.add_user(dbu)
+    for text in scim_pages(groups, {"id", "displayName", "members"}):
+        for dbg in json.loads(text)["Resources"]:
+            directory.add_group(dbg)
+    return directory
+
+
+def measure(reader, users, groups):
+    tracemalloc.start()
+    result = reader(users, groups)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del result
+    return peak
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Peak memory of the Databricks directory readers")
+    parser.add_argument("--users", type=int, default=50000)
+    parser.add_argument("--groups", type=int, default=2000)
+    parser.add_argument("--members", type=int, default=200, help="members per group")
+    args = parser.parse_args(argv)
+
+    rnd = random.Random(0)
+    memberships = {g: rnd.sample(range(args.users), min(args.members, args.users)) for g in range(args.groups)}
+    user_groups = {}
+    for g, member_ids in memberships.items():
+        for m in member_ids:
+            user_groups.setdefault(m, []).append(g)
+
+    # The source resources live outside the traced window, only the readers are measured
+    users = [full_user(i, user_groups.get(i, [])) for i in range(args.users)]
+    groups = [full_group(g, member_ids) for g, member_ids in memberships.items()]
+
+    list_peak = measure(list_readers, users, groups)
+    streaming_peak = measure(streaming_readers, users, groups)
+
+    print(f"users={args.users} groups={args.groups} members/group={args.members}")
+    print(f"list readers      peak={list_peak / 2 ** 20:8.1f} MiB")
+    print(f"streaming readers peak={streaming_peak / 2 ** 20:8.1f} MiB ({list_peak / streaming_peak:.1f}x less)")
+
+
+if __name__ == "__main__":
+    main()
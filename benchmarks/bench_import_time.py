@@ -0,0 +1,79 @@
+'''
+Import time regression benchmark of the package entry points, measured with python -X importtime in a fresh
+interpreter per entry point. Each entry point lists the heavy packages it must not load, plan inspection and
+the CLI must start without the Graph, Azure identity and HTTP client stacks.
+Exits with status 1 when a forbidden package is imported or an entry point exceeds --max-ms
+'''
+import argparse
+import subprocess
+import sys
+
+GRAPH_SDK = ("msgraph", "msgraph_core", "kiota_abstractions", "kiota_http", "azure")
+
+'''
+Module imported by each entry point and the top level packages it must not import
+'''
+ENTRY_POINTS = {
+    "nestedaaddb.cli": GRAPH_SDK + ("httpx", "requests"),
+    "nestedaaddb.sync_plan": GRAPH_SDK + ("httpx", "requests"),
+    "nestedaaddb.graph_client": GRAPH_SDK + ("httpx", "requests"),
+    "nestedaaddb.nested_groups": GRAPH_SDK + ("requests",),
+    "nestedaaddb.daemon": GRAPH_SDK + ("requests",),
+}
+
+
+'''
+Import a module in a fresh interpreter.
+Returns the cumulative import time in microseconds of every module imported, keyed by module name
+'''
+
+
+def import_times(module):
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {module}"],
+                            capture_output=True, text=True)
+    if result.returncode != 0:
+        raise RuntimeError(f"import {module} failed:\n{result.stderr.strip().splitlines()[-1]}")
+
+    times = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "[us]" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        times[name.strip()] = int(cumulative)
+    return times
+
+
+def run(max_ms, repeat):
+    failed = False
+    for module, forbidden in ENTRY_POINTS.items():
+        try:
+            runs = [import_times(module) for _ in range(repeat)]
+        except RuntimeError as e:
+            print(f"{module:<28} skipped: {e}")
+            continue
+
+        # Best of the runs, the first one also pays for reading the files from disk
+        total_ms = min(times[module] for times in runs) / 1000
+        loaded = sorted({name.split(".")[0] for name in runs[0]} & set(forbidden))
+        heaviest = sorted(((us, name) for name, us in runs[0].items()
+                           if not name.startswith("nestedaaddb") and "." not in name), reverse=True)[:3]
+
+        status = "ok"
+        if loaded:
+            status = f"REGRESSION imports {', '.join(loaded)}"
+        elif max_ms is not None and total_ms > max_ms:
+            status = f"REGRESSION over {max_ms}ms"
+        failed = failed or status != "ok"
+
+        print(f"{module:<28} {total_ms:8.1f}ms  {status:<10} heaviest: "
+              + ", ".join(f"{name} {us / 1000:.1f}ms" for us, name in heaviest))
+
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--max-ms", type=float, default=None, help="import time budget of every entry point")
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+    sys.exit(run(args.max_ms, args.repeat))
@@ -0,0 +1,46 @@
+'''
+Benchmark of the membership diff engine for groups of 10, 1k and 50k members.
+A tenth of the AAD members are missing in Databricks and a tenth of the Databricks members are stale
+'''
+import time
+
+from nestedaaddb.databricks_directory import DatabricksDirectory
+from nestedaaddb.membership_graph import MembershipGraph
+from nestedaaddb.membership_diff import compute_membership_diff, resolve_member_ids, build_patch_requests
+
+SIZES = [10, 1000, 50000]
+
+
+def build_group(size):
+    drift = max(1, size // 10)
+
+    graph = MembershipGraph()
+    graph.add_members("Group", [graph.user(f"User {i}", f"user{i}@example.com") for i in range(size)])
+    members = graph.get("Group")
+
+    dbusers = [{"id": str(i), "userName": f"USER{i}@example.com"} for i in range(size + drift)]
+    dbg = {
+        "id": "g1",
+        "displayName": "Group",
+        "members": [{"value": str(i), "display": f"User {i}", "$ref": f"Users/{i}"} for i in range(drift, size + drift)]
+    }
+
+    return members, dbg, DatabricksDirectory(dbusers, [dbg])
+
+
+def run():
+    for size in SIZES:
+        members, dbg, directory = build_group(size)
+
+        start = time.perf_counter()
+        toadd, toremove = compute_membership_diff(members, dbg, directory)
+        requests = build_patch_requests(resolve_member_ids(toadd, directory),
+                                        [m["value"] for m in toremove])
+        elapsed = time.perf_counter() - start
+
+        print(f"members={size:>6} adds={len(toadd):>5} removes={len(toremove):>5} "
+              f"requests={len(requests):>3} diff_time={elapsed * 1000:.2f}ms")
+
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,81 @@
+'''
+Memory and build time of the AAD membership map: the former defaultdict(set) of hashable dictionaries
+compared to the interned MembershipGraph. Groups draw their members from a shared pool of users,
+so most principals are members of several groups as in a real hierarchy.
+
+python -m benchmarks.bench_membership_graph --groups 5000 --members 100 --users 50000
+'''
+import argparse
+import random
+import time
+import tracemalloc
+from collections import defaultdict
+
+from nestedaaddb.membership_graph import MembershipGraph
+
+
+class HashableDict(dict):
+    def __hash__(self):
+        return hash(frozenset(self.items()))
+
+
+def build_dict_map(edges):
+    parent_map = defaultdict(set)
+    for group_name, kind, display_name, user_principal_name in edges:
+        if kind == "user":
+            parent_map[group_name].add(HashableDict({'type': 'user', 'display_name': display_name,
+                                                     'user_principal_name': user_principal_name}))
+        else:
+            parent_map[group_name].add(HashableDict({'type': 'group', 'display_name': display_name}))
+    return parent_map
+
+
+def build_graph(edges):
+    graph = MembershipGraph()
+    members = defaultdict(list)
+    for group_name, kind, display_name, user_principal_name in edges:
+        if kind == "user":
+            members[group_name].append(graph.user(display_name, user_principal_name))
+        else:
+            members[group_name].append(graph.group(display_name))
+    for group_name, member_ids in members.items():
+        graph.add_members(group_name, member_ids)
+    return graph
+
+
+def measure(build, edges):
+    tracemalloc.start()
+    start = time.perf_counter()
+    result = build(edges)
+    elapsed = time.perf_counter() - start
+    current, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del result
+    return current, elapsed
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Memory of the AAD membership map")
+    parser.add_argument("--groups", type=int, default=5000)
+    parser.add_argument("--members", type=int, default=100, help="user members per group")
+    parser.add_argument("--users", type=int, default=50000)
+    parser.add_argument("--fanout", type=int, default=3, help="child groups per group")
+    args = parser.parse_args(argv)
+
+    rnd = random.Random(0)
+    users = [(f"User {i}", f"user{i}@example.com") for i in range(args.users)]
+    edges = []
+    for g in range(args.groups):
+        for display_name, user_principal_name in rnd.sample(users, min(args.members, args.users)):
+            edges.append((f"Group {g}", "user", display_name, user_principal_name))
+        for child in range(g * args.fanout + 1, min(args.groups, (g + 1) * args.fanout + 1)):
+            edges.append((f"Group {g}", "group", f"Group {child}", None))
+
+    print(f"groups={args.groups} users={args.users} edges={len(edges)}")
+    for name, build in (("dict sets", build_dict_map), ("membership graph", build_graph)):
+        memory, elapsed = measure(build, edges)
+        print(f"{name:<17} memory={memory / 2 ** 20:8.1f} MiB build={elapsed:6.2f}s")
+
+
+if __name__ == "__main__":
+    main()
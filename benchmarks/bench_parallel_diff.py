@@ -0,0 +1,41 @@
+'''
+Benchmark of the membership diff stage with 1 to N worker processes.
+Every run is checked to return exactly the diffs of the serial path
+'''
+import argparse
+import asyncio
+import os
+import time
+
+from benchmarks.bench_diff_logging import build_tenant
+from nestedaaddb.parallel_diff import DiffSnapshot, diff_groups, diff_groups_parallel
+
+
+def run(groups, size, worker_counts):
+    graph, dbgroups, directory = build_tenant(groups, size)
+    names = [dbg["displayName"] for dbg in dbgroups]
+    snapshot = DiffSnapshot(graph, directory, {})
+    print(f"groups={groups} members={size} memberships={graph.edge_count()}")
+
+    start = time.perf_counter()
+    expected = diff_groups(names, snapshot)
+    serial = time.perf_counter() - start
+    print(f"workers=serial time={serial:.3f}s")
+
+    for workers in worker_counts:
+        start = time.perf_counter()
+        diffs = asyncio.run(diff_groups_parallel(names, snapshot, workers))
+        elapsed = time.perf_counter() - start
+        if diffs != expected:
+            raise AssertionError(f"{workers} workers returned different diffs than the serial path")
+        print(f"workers={workers:>6} time={elapsed:.3f}s speedup={serial / elapsed:.2f}x")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--groups", type=int, default=400)
+    parser.add_argument("--members", type=int, default=2000)
+    parser.add_argument("--workers", type=int, nargs="+",
+                        default=sorted({1, 2, 4, min(8, os.cpu_count() or 1)}))
+    args = parser.parse_args()
+    run(args.groups, args.members, args.workers)
@@ -0,0 +1,96 @@
+'''
+Compare the recursive and transitive hierarchy traversal engines of Graph against the local Graph stand-in.
+Each engine must resolve exactly the memberships of the stand-in tenant, otherwise the benchmark fails.
+The wall time and the Graph requests of each engine are reported.
+A per request latency models the round trip to Graph, which is what the transitive engine saves on.
+
+python -m benchmarks.bench_traversal --depth 5 --fanout 3 --latency 0.05
+'''
+import argparse
+import asyncio
+import json
+import multiprocessing
+import sys
+import time
+
+from benchmarks.run_scale import _stats, local_graph_client
+from benchmarks.standins import start_standins
+from benchmarks.tenant import SyntheticTenant
+
+
+def _serve(tenant_args, latency, conn):
+    tenant = SyntheticTenant(**tenant_args)
+    graph, _ = start_standins(tenant, latency=latency)
+    conn.send((graph.url, tenant.root_name, tenant.summary(), tenant.expected_memberships()))
+    conn.recv()
+
+
+async def _resolve(graph, root_name):
+    from nestedaaddb.graph_client import build_hierarchy
+
+    group = (await graph.get_group_by_name(root_name)).value[0]
+    adjacency = await graph.fetch_group_adjacency(group.id, group.display_name)
+    _, _, parent_map = build_hierarchy(group.id, adjacency, set(), set())
+    return {name: {member.key for member in parent_map.get(name)} for name in parent_map.group_names()}
+
+
+def measure(graph_url, root_name, traversal, args):
+    from nestedaaddb.graph_client import Graph
+
+    graph = Graph(max_concurrency=args.graph_concurrency, use_batch=not args.no_graph_batch,
+                  client=local_graph_client(graph_url), traversal=traversal)
+
+    before = _stats(graph_url)
+    start = time.perf_counter()
+    hierarchy = asyncio.run(_resolve(graph, root_name))
+    wall_time = time.perf_counter() - start
+    after = _stats(graph_url)
+
+    requests = {endpoint: count - before.get(endpoint, 0) for endpoint, count in after.items()
+                if count != before.get(endpoint, 0)}
+    return hierarchy, {"wall_time_s": round(wall_time, 3), "graph_requests": requests}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Recursive vs transitive Graph hierarchy traversal")
+    parser.add_argument("--depth", type=int, default=4)
+    parser.add_argument("--fanout", type=int, default=3)
+    parser.add_argument("--users", type=int, default=5000)
+    parser.add_argument("--users-per-group", type=int, default=50)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--latency", type=float, default=0.02, help="seconds added to every stand-in request")
+    parser.add_argument("--graph-concurrency", type=int, default=10)
+    parser.add_argument("--no-graph-batch", action="store_true")
+    args = parser.parse_args(argv)
+
+    tenant_args = {"depth": args.depth, "fanout": args.fanout, "users": args.users,
+                   "users_per_group": args.users_per_group, "seed": args.seed}
+
+    parent_conn, child_conn = multiprocessing.Pipe()
+    server = multiprocessing.Process(target=_serve, args=(tenant_args, args.latency, child_conn), daemon=True)
+    server.start()
+    graph_url, root_name, summary, expected = parent_conn.recv()
+
+    failed = []
+    try:
+        report = {"tenant": summary, "latency_s": args.latency}
+        for traversal in ("recursive", "transitive"):
+            hierarchy, report[traversal] = measure(graph_url, root_name, traversal, args)
+            report[traversal]["memberships"] = sum(len(members) for members in hierarchy.values())
+            # An empty hierarchy would also match an empty expectation, so it is always a failure
+            report[traversal]["matches_tenant"] = bool(hierarchy) and hierarchy == expected
+            if not report[traversal]["matches_tenant"]:
+                failed.append(traversal)
+        report["expected_memberships"] = sum(len(members) for members in expected.values())
+    finally:
+        parent_conn.send("stop")
+        server.join(timeout=5)
+
+    json.dump(report, sys.stdout, indent=2)
+    print()
+    if failed:
+        sys.exit(f"{', '.join(failed)} traversal did not resolve the memberships of the tenant")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,188 @@
+'''
+End to end scale benchmark of SyncNestedGroups.sync against the local stand-ins.
+The stand-ins run in a child process so the reported peak RSS only covers the sync.
+Unless it is a dry run, the benchmark fails when Databricks does not end up with the memberships of the tenant
+or when a second sync still changes Databricks.
+
+python -m benchmarks.run_scale --depth 3 --fanout 5 --users 20000 --users-per-group 200 --drift 0.05
+'''
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import resource
+import sys
+import time
+import urllib.request
+
+from benchmarks.standins import GRAPH_PREFIX, SCIM_PREFIX, start_standins
+from benchmarks.tenant import SyntheticTenant
+
+
+def _serve(tenant_args, bulk, conn, latency=0.0):
+    tenant = SyntheticTenant(**tenant_args)
+    graph, scim = start_standins(tenant, bulk, latency)
+    conn.send((graph.url, scim.url, tenant.root_name, tenant.summary(), tenant.expected_memberships()))
+    conn.recv()
+
+
+def _stats(url):
+    with urllib.request.urlopen(url + "/__stats") as response:
+        return json.loads(response.read())
+
+
+'''
+All resources of a SCIM stand-in listing, page by page
+'''
+
+
+def _scim_resources(scim_url, resource_type):
+    resources = []
+    while True:
+        url = f"{scim_url}{SCIM_PREFIX}/{resource_type}?startIndex={len(resources) + 1}&count=1000"
+        with urllib.request.urlopen(url) as response:
+            page = json.loads(response.read())
+        resources.extend(page["Resources"])
+        if not page["Resources"] or len(resources) >= page["totalResults"]:
+            return resources
+
+
+'''
+Group names of the tenant whose Databricks members differ from their AAD members, read back from the SCIM stand-in
+'''
+
+
+def _diverged_groups(scim_url, expected):
+    names = {("user", dbu["id"]): dbu["userName"] for dbu in _scim_resources(scim_url, "Users")}
+    dbgroups = _scim_resources(scim_url, "Groups")
+    names.update({("group", dbg["id"]): dbg["displayName"] for dbg in dbgroups})
+    members = {}
+    for dbg in dbgroups:
+        keys = set()
+        for member in dbg["members"]:
+            kind = "group" if member["$ref"].startswith("Groups/") else "user"
+            keys.add((kind, names.get((kind, member["value"]), member["value"]).casefold()))
+        members[dbg["displayName"]] = keys
+    return sorted(name for name, keys in expected.items() if members.get(name) != keys)
+
+
+'''
+SCIM requests changing Databricks, counted by the SCIM stand-in
+'''
+
+
+def _writes(scim_stats):
+    return {endpoint: count for endpoint, count in scim_stats.items() if not endpoint.startswith("GET ")}
+
+
+'''
+GraphServiceClient talking to the Graph stand-in without authentication
+'''
+
+
+def local_graph_client(graph_url):
+    from kiota_abstractions.authentication import AnonymousAuthenticationProvider
+    from nestedaaddb.graph_client import create_graph_client
+
+    return create_graph_client(AnonymousAuthenticationProvider(), graph_url + GRAPH_PREFIX)
+
+
+def run(args):
+    tenant_args = {
+        "depth": args.depth,
+        "fanout": args.fanout,
+        "users": args.users,
+        "users_per_group": args.users_per_group,
+        "overlap": args.overlap,
+        "drift": args.drift,
+        "seed": args.seed
+    }
+
+    parent_conn, child_conn = multiprocessing.Pipe()
+    server = multiprocessing.Process(target=_serve, args=(tenant_args, not args.no_bulk, child_conn, args.latency),
+                                     daemon=True)
+    server.start()
+    graph_url, scim_url, root_name, summary, expected = parent_conn.recv()
+
+    try:
+        os.environ["DB_BASE_URL"] = scim_url + SCIM_PREFIX
+        os.environ["DB_SCIM_TOKEN"] = "benchmark"
+
+        from nestedaaddb.graph_client import Graph
+        from nestedaaddb.nested_groups import SyncNestedGroups
+
+        async def sync():
+            sn = SyncNestedGroups(db_concurrency=args.db_concurrency,
+                                  graph=Graph(max_concurrency=args.graph_concurrency,
+                                              use_batch=not args.no_graph_batch,
+                                              traversal=args.graph_traversal,
+                                              client=local_graph_client(graph_url)))
+            try:
+                return await sn.sync(root_name, args.dryrun)
+            finally:
+                await sn.close()
+
+        start = time.perf_counter()
+        run_report = asyncio.run(sync())
+        wall_time = time.perf_counter() - start
+
+        report = {
+            "tenant": summary,
+            "wall_time_s": round(wall_time, 3),
+            "peak_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+            "graph_requests": _stats(graph_url),
+            "scim_requests": _stats(scim_url),
+            "run_report": run_report
+        }
+
+        if not args.dryrun:
+            # Checked after the measurements so the extra requests stay out of the reported stats
+            diverged = _diverged_groups(scim_url, expected)
+            writes = _writes(_stats(scim_url))
+            asyncio.run(sync())
+            second_run_writes = {endpoint: count - writes.get(endpoint, 0)
+                                 for endpoint, count in _writes(_stats(scim_url)).items()
+                                 if count != writes.get(endpoint, 0)}
+            report["convergence"] = {
+                "diverged_groups": diverged,
+                "second_run_writes": second_run_writes,
+                "converged": not diverged and not second_run_writes
+            }
+    finally:
+        parent_conn.send("stop")
+        server.join(timeout=5)
+
+    return report
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Scale benchmark of nestedaaddb against local stand-ins")
+    parser.add_argument("--depth", type=int, default=3)
+    parser.add_argument("--fanout", type=int, default=4)
+    parser.add_argument("--users", type=int, default=5000)
+    parser.add_argument("--users-per-group", type=int, default=50)
+    parser.add_argument("--overlap", type=float, default=0.2)
+    parser.add_argument("--drift", type=float, default=0.05)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--graph-concurrency", type=int, default=10)
+    parser.add_argument("--db-concurrency", type=int, default=8)
+    parser.add_argument("--no-graph-batch", action="store_true")
+    parser.add_argument("--graph-traversal", choices=("recursive", "transitive"), default="recursive")
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds added to every stand-in request")
+    parser.add_argument("--no-bulk", action="store_true", help="answer SCIM /Bulk with 501")
+    parser.add_argument("--dryrun", action="store_true")
+    args = parser.parse_args(argv)
+
+    report = run(args)
+    json.dump(report, sys.stdout, indent=2)
+    print()
+
+    convergence = report.get("convergence")
+    if convergence is not None and not convergence["converged"]:
+        sys.exit(f"Databricks did not converge: {len(convergence['diverged_groups'])} groups differ from AAD, "
+                 f"second run writes {convergence['second_run_writes']}")
+
+
+if __name__ == "__main__":
+    main()
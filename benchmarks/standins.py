@@ -0,0 +1,322 @@
+'''
+Local stand-ins for the Microsoft Graph and Databricks SCIM endpoints used by nestedaaddb.
+Both are served from a SyntheticTenant and count the requests received per endpoint.
+GET /__stats on either server returns the counters
+'''
+import json
+import re
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qs
+
+GRAPH_PREFIX = "/v1.0"
+SCIM_PREFIX = "/scim"
+
+_GROUP_FILTER = re.compile(r"displayName eq ['\"](.*)['\"]$")
+_USER_FILTER = re.compile(r"userName eq ['\"](.*)['\"]$")
+_GROUP_IN_FILTER = re.compile(r"displayName in \((.*)\)$")
+_QUOTED = re.compile(r"'((?:[^']|'')*)'")
+
+
+def _filter_names(value):
+    match = _GROUP_FILTER.match(value)
+    if match:
+        return {match.group(1).casefold()}
+    match = _GROUP_IN_FILTER.match(value)
+    if match:
+        return {name.replace("''", "'").casefold() for name in _QUOTED.findall(match.group(1))}
+    return None
+
+
+class StandInServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    '''
+    latency : seconds every request is delayed by, to model the round trip to the real service
+    '''
+
+    def __init__(self, tenant, handler, latency=0.0):
+        super().__init__(("127.0.0.1", 0), handler)
+        self.tenant = tenant
+        self.latency = latency
+        self.counts = Counter()
+        self.lock = threading.Lock()
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+    def count(self, endpoint):
+        with self.lock:
+            self.counts[endpoint] += 1
+
+
+class _JsonHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send(self, status, body=None, headers=None):
+        payload = json.dumps(body).encode() if body is not None else b""
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def _body(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        return json.loads(self.rfile.read(length)) if length else None
+
+    def _dispatch(self, method):
+        parts = urlsplit(self.path)
+        if parts.path == "/__stats":
+            return self._send(200, dict(self.server.counts))
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        query = {k: v[0] for k, v in parse_qs(parts.query).items()}
+        status, body, headers = self.route(method, parts.path, query, self._body())
+        self._send(status, body, headers)
+
+    def do_GET(self):
+        self._dispatch("GET")
+
+    def do_POST(self):
+        self._dispatch("POST")
+
+    def do_PATCH(self):
+        self._dispatch("PATCH")
+
+    def do_DELETE(self):
+        self._dispatch("DELETE")
+
+
+'''
+Graph stand-in: groups by name, group members and transitive member groups with paging and JSON $batch
+'''
+
+
+class GraphHandler(_JsonHandler):
+
+    def route(self, method, path, query, body):
+        path = path[len(GRAPH_PREFIX):] if path.startswith(GRAPH_PREFIX) else path
+
+        if method == "POST" and path == "/$batch":
+            self.server.count("POST /$batch")
+            responses = []
+            for request in body["requests"]:
+                parts = urlsplit(request["url"])
+                sub_path = parts.path[len(GRAPH_PREFIX):] if parts.path.startswith(GRAPH_PREFIX) else parts.path
+                sub_query = {k: v[0] for k, v in parse_qs(parts.query).items()}
+                status, sub_body, headers = self._get(sub_path, sub_query, "batch:")
+                responses.append({"id": request["id"], "status": status, "headers": headers or {}, "body": sub_body})
+            return 200, {"responses": responses}, None
+
+        if method == "GET":
+            return self._get(path, query, "")
+
+        return 404, {"error": {"code": "NotFound"}}, None
+
+    def _get(self, path, query, prefix):
+        tenant = self.server.tenant
+        segments = path.strip("/").split("/")
+
+        if segments == ["groups"]:
+            self.server.count(prefix + "GET /groups")
+            names = _filter_names(query.get("$filter", ""))
+            groups = [
+                {"id": gid, "displayName": g["displayName"]}
+                for gid, g in tenant.groups.items()
+                if names is None or g["displayName"].casefold() in names
+            ]
+            return 200, {"value": groups}, None
+
+        if len(segments) == 3 and segments[0] == "groups" and segments[2] == "members":
+            self.server.count(prefix + "GET /groups/{id}/members")
+            group = tenant.groups.get(segments[1])
+            if group is None:
+                return 404, {"error": {"code": "Request_ResourceNotFound"}}, None
+
+            top = int(query.get("$top", 100))
+            skip = int(query.get("$skiptoken", 0))
+            page = group["members"][skip:skip + top]
+            value = []
+            for kind, member_id in page:
+                if kind == "user":
+                    user = tenant.users[member_id]
+                    value.append({"@odata.type": "#microsoft.graph.user", "id": member_id,
+                                  "displayName": user["displayName"],
+                                  "userPrincipalName": user["userPrincipalName"]})
+                else:
+                    value.append({"@odata.type": "#microsoft.graph.group", "id": member_id,
+                                  "displayName": tenant.groups[member_id]["displayName"]})
+
+            result = {"value": value}
+            if skip + top < len(group["members"]):
+                result["@odata.nextLink"] = (f"{self.server.url}{GRAPH_PREFIX}/groups/{segments[1]}/members"
+                                             f"?$top={top}&$skiptoken={skip + top}")
+            return 200, result, None
+
+        if (len(segments) == 4 and segments[0] == "groups" and segments[2] == "transitiveMembers"
+                and segments[3] in ("graph.group", "microsoft.graph.group")):
+            self.server.count(prefix + "GET /groups/{id}/transitiveMembers/microsoft.graph.group")
+            if segments[1] not in tenant.groups:
+                return 404, {"error": {"code": "Request_ResourceNotFound"}}, None
+
+            nested = []
+            seen = {segments[1]}
+            stack = [segments[1]]
+            while stack:
+                for kind, member_id in tenant.groups[stack.pop()]["members"]:
+                    if kind == "group" and member_id not in seen:
+                        seen.add(member_id)
+                        nested.append(member_id)
+                        stack.append(member_id)
+
+            top = int(query.get("$top", 100))
+            skip = int(query.get("$skiptoken", 0))
+            value = [{"@odata.type": "#microsoft.graph.group", "id": member_id,
+                      "displayName": tenant.groups[member_id]["displayName"]}
+                     for member_id in nested[skip:skip + top]]
+
+            result = {"value": value}
+            if skip + top < len(nested):
+                result["@odata.nextLink"] = (f"{self.server.url}{GRAPH_PREFIX}/groups/{segments[1]}/transitiveMembers/"
+                                             f"microsoft.graph.group?$top={top}&$skiptoken={skip + top}")
+            return 200, result, None
+
+        return 404, {"error": {"code": "NotFound"}}, None
+
+
+'''
+SCIM stand-in: users and groups listing, creates, group patches, deletes and optionally /Bulk
+'''
+
+
+class ScimHandler(_JsonHandler):
+
+    def route(self, method, path, query, body):
+        tenant = self.server.tenant
+        path = path[len(SCIM_PREFIX):] if path.startswith(SCIM_PREFIX) else path
+        segments = path.strip("/").split("/")
+
+        with self.server.lock:
+            if segments == ["Users"] and method == "GET":
+                self.server.counts["GET /Users"] += 1
+                users = list(tenant.db_users.values())
+                match = _USER_FILTER.match(query.get("filter", ""))
+                if match:
+                    users = [u for u in users if u["userName"].casefold() == match.group(1).casefold()]
+                return 200, self._page(users, query), None
+
+            if segments == ["Groups"] and method == "GET":
+                self.server.counts["GET /Groups"] += 1
+                groups = list(tenant.db_groups.values())
+                match = _GROUP_FILTER.match(query.get("filter", ""))
+                if match:
+                    groups = [g for g in groups if g["displayName"].casefold() == match.group(1).casefold()]
+                return 200, self._page(groups, query), None
+
+            if segments == ["Users"] and method == "POST":
+                self.server.counts["POST /Users"] += 1
+                return self._create("Users", body) + (None,)
+
+            if segments == ["Groups"] and method == "POST":
+                self.server.counts["POST /Groups"] += 1
+                return self._create("Groups", body) + (None,)
+
+            if segments == ["Bulk"] and method == "POST":
+                self.server.counts["POST /Bulk"] += 1
+                if not self.server.bulk:
+                    return 501, {"detail": "Bulk not supported"}, None
+                operations = []
+                for op in body["Operations"]:
+                    status, resource = self._create(op["path"].strip("/"), op["data"])
+                    if status != 201:
+                        operations.append({"bulkId": op["bulkId"], "method": "POST", "status": str(status),
+                                           "response": resource})
+                        continue
+                    operations.append({"bulkId": op["bulkId"], "method": "POST", "status": "201",
+                                       "location": f"{self.server.url}{SCIM_PREFIX}{op['path']}/{resource['id']}"})
+                return 200, {"schemas": ["urn:ietf:params:scim:api:messages:2.0:BulkResponse"],
+                             "Operations": operations}, None
+
+            if len(segments) == 2 and segments[0] == "Groups" and method == "PATCH":
+                self.server.counts["PATCH /Groups/{id}"] += 1
+                return self._patch(segments[1], body)
+
+            if len(segments) == 2 and method == "DELETE":
+                self.server.counts[f"DELETE /{segments[0]}/{{id}}"] += 1
+                store = tenant.db_users if segments[0] == "Users" else tenant.db_groups
+                store.pop(segments[1], None)
+                return 204, None, None
+
+        return 404, {"detail": "Not found"}, None
+
+    @staticmethod
+    def _page(resources, query):
+        start = int(query.get("startIndex", 1))
+        count = int(query.get("count", 100))
+        return {"totalResults": len(resources), "startIndex": start,
+                "itemsPerPage": count, "Resources": resources[start - 1:start - 1 + count]}
+
+    '''
+    Create a user or group, returns (status, resource or error), 409 like Databricks when it already exists
+    '''
+
+    def _create(self, kind, data):
+        tenant = self.server.tenant
+        if kind == "Users":
+            if any(u["userName"].casefold() == data["userName"].casefold() for u in tenant.db_users.values()):
+                return 409, _conflict(f"User {data['userName']} already exists")
+            uid = f"db-new-u{len(tenant.db_users)}"
+            tenant.db_users[uid] = {"id": uid, "userName": data["userName"], "displayName": data.get("displayName")}
+            return 201, tenant.db_users[uid]
+        if any(g["displayName"].casefold() == data["displayName"].casefold() for g in tenant.db_groups.values()):
+            return 409, _conflict(f"Group with name {data['displayName']} already exists")
+        gid = f"db-new-g{len(tenant.db_groups)}"
+        tenant.db_groups[gid] = {"id": gid, "displayName": data["displayName"], "members": []}
+        return 201, tenant.db_groups[gid]
+
+    def _patch(self, gid, body):
+        tenant = self.server.tenant
+        dbg = tenant.db_groups.get(gid)
+        if dbg is None:
+            return 404, {"detail": "Group not found"}, None
+
+        for op in body.get("Operations", []):
+            ids = {v["value"] for v in op.get("value", [])}
+            if op["op"] == "remove":
+                dbg["members"] = [m for m in dbg["members"] if m["value"] not in ids]
+            elif op["op"] == "add":
+                existing = {m["value"] for m in dbg["members"]}
+                for member_id in ids - existing:
+                    kind = "user" if member_id in tenant.db_users else "group"
+                    ref = tenant.db_ref(kind, member_id)
+                    if ref is not None:
+                        dbg["members"].append(ref)
+        return 204, None, None
+
+
+def _conflict(detail):
+    return {"schemas": ["urn:ietf:params:scim:api:messages:2.0:Error"], "detail": detail, "status": "409"}
+
+
+'''
+Start both stand-ins on free local ports, each served from a background thread.
+Returns (graph server, scim server)
+'''
+
+
+def start_standins(tenant, bulk=True, latency=0.0):
+    graph = StandInServer(tenant, GraphHandler, latency)
+    scim = StandInServer(tenant, ScimHandler, latency)
+    scim.bulk = bulk
+    for server in (graph, scim):
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+    return graph, scim
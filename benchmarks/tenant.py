@@ -0,0 +1,132 @@
+'''
+Synthetic tenants for the scale benchmarks.
+A tenant is a tree of AAD groups under a single top level group plus a Databricks workspace that
+mirrors it with a configurable amount of drift
+'''
+import random
+
+
+class SyntheticTenant:
+    '''
+    depth : number of group levels below the top level group
+    fanout : number of child groups of every group above the last level
+    users : number of users in the tenant
+    users_per_group : number of direct user members of every group
+    overlap : fraction of the members of a group drawn from the whole tenant instead of the users
+              assigned to that group, i.e. how much memberships overlap between groups
+    drift : fraction of users, groups and memberships that differ between AAD and Databricks
+    '''
+
+    def __init__(self, depth=3, fanout=4, users=1000, users_per_group=50, overlap=0.2, drift=0.05, seed=0):
+        self.depth = depth
+        self.fanout = fanout
+        self.drift = drift
+        self.root_name = "bench-root"
+
+        rnd = random.Random(seed)
+
+        # AAD side: users and groups keyed by id
+        self.users = {f"u{i}": {"displayName": f"User {i}", "userPrincipalName": f"user{i}@bench.example.com"}
+                      for i in range(users)}
+        user_ids = list(self.users)
+
+        self.groups = {}
+        level = [self._add_group("g0", self.root_name)]
+        for _ in range(depth):
+            next_level = []
+            for gid in level:
+                for _ in range(fanout):
+                    child = self._add_group(f"g{len(self.groups)}", f"bench-group-{len(self.groups)}")
+                    self.groups[gid]["members"].append(("group", child))
+                    next_level.append(child)
+            level = next_level
+
+        for index, group in enumerate(self.groups.values()):
+            members = set()
+            for slot in range(users_per_group):
+                if rnd.random() < overlap:
+                    members.add(rnd.choice(user_ids))
+                else:
+                    members.add(user_ids[(index * users_per_group + slot) % len(user_ids)])
+            group["members"].extend(("user", uid) for uid in sorted(members))
+
+        # Databricks side: the same principals minus the drift, memberships with missing and stale entries
+        self.db_users = {}
+        for uid, user in self.users.items():
+            if rnd.random() >= drift:
+                self.db_users["db-" + uid] = {"id": "db-" + uid, "userName": user["userPrincipalName"],
+                                              "displayName": user["displayName"]}
+
+        self.db_groups = {}
+        for gid, group in self.groups.items():
+            if gid == "g0" or rnd.random() >= drift:
+                self.db_groups["db-" + gid] = {"id": "db-" + gid, "displayName": group["displayName"], "members": []}
+
+        db_user_ids = list(self.db_users)
+        for gid, group in self.groups.items():
+            dbg = self.db_groups.get("db-" + gid)
+            if dbg is None:
+                continue
+            for kind, member_id in group["members"]:
+                if rnd.random() < drift:
+                    continue
+                ref = self.db_ref(kind, "db-" + member_id)
+                if ref is not None:
+                    dbg["members"].append(ref)
+            for _ in range(int(len(group["members"]) * drift)):
+                dbg["members"].append(self.db_ref("user", rnd.choice(db_user_ids)))
+
+    def _add_group(self, gid, name):
+        self.groups[gid] = {"displayName": name, "members": []}
+        return gid
+
+    '''
+    Databricks member reference of a user or group, None when the principal does not exist in Databricks
+    '''
+
+    def db_ref(self, kind, db_id):
+        if kind == "user":
+            dbu = self.db_users.get(db_id)
+            if dbu is None:
+                return None
+            return {"value": db_id, "display": dbu["displayName"], "$ref": f"Users/{db_id}"}
+        dbg = self.db_groups.get(db_id)
+        if dbg is None:
+            return None
+        return {"value": db_id, "display": dbg["displayName"], "$ref": f"Groups/{db_id}"}
+
+    '''
+    Direct members of every AAD group reachable from the top level group, keyed like the diff engine keys them:
+    ("user", user principal name) or ("group", display name), casefolded. Groups without members are left out
+    '''
+
+    def expected_memberships(self):
+        memberships = {}
+        seen = {"g0"}
+        stack = ["g0"]
+        while stack:
+            group = self.groups[stack.pop()]
+            keys = set()
+            for kind, member_id in group["members"]:
+                if kind == "user":
+                    keys.add(("user", self.users[member_id]["userPrincipalName"].casefold()))
+                else:
+                    keys.add(("group", self.groups[member_id]["displayName"].casefold()))
+                    if member_id not in seen:
+                        seen.add(member_id)
+                        stack.append(member_id)
+            if keys:
+                memberships[group["displayName"]] = keys
+        return memberships
+
+    def summary(self):
+        return {
+            "depth": self.depth,
+            "fanout": self.fanout,
+            "aad_users": len(self.users),
+            "aad_groups": len(self.groups),
+            "aad_memberships": sum(len(g["members"]) for g in self.groups.values()),
+            "db_users": len(self.db_users),
+            "db_groups": len(self.db_groups),
+            "drift": self.drift
+        }
@@ -0,0 +1,5 @@
+import sys
+
+from nestedaaddb.cli import main
+
+sys.exit(main())
@@ -0,0 +1,272 @@
+import asyncio
+import json
+import os
+import logging
+import time
+
+import httpx
+
+from nestedaaddb.databricks_client import PAGE_SIZE, USER_ATTRIBUTES, GROUP_ATTRIBUTES, user_payload, group_payload, \
+    created_resource, check_response, log_patch_request, is_conflict
+from nestedaaddb.throttle import get_governor
+from nestedaaddb.membership_diff import DEFAULT_MAX_PATCH_OPS, build_patch_requests
+
+'''
+Async Databricks client to interact with Databricks SCIM API's
+All calls share one pooled keep-alive HTTP session and at most max_concurrency requests are in flight,
+so independent writes can be issued together with asyncio.gather.
+Requests go through the rate governor of the SCIM service, which retries throttled and failed requests
+https://docs.databricks.com/dev-tools/api/latest/scim/account-scim.html
+'''
+
+
+class AsyncDatabricksClient:
+    dbbaseUrl: str
+    dbscimToken: str
+    maxPatchOps: int
+    maxConcurrency: int
+
+    '''
+    governor : optional rate governor, by default the one shared by every client of the SCIM service
+    base_url, scim_token : SCIM endpoint and token, by default read from DB_BASE_URL and DB_SCIM_TOKEN
+    '''
+
+    def __init__(self, max_concurrency=None, max_patch_ops=None, governor=None, base_url=None, scim_token=None):
+        self.dbbaseUrl = base_url or os.environ.get('DB_BASE_URL')
+        self.dbscimToken = scim_token or os.environ.get('DB_SCIM_TOKEN')
+        self.maxPatchOps = max_patch_ops or int(os.environ.get('DB_PATCH_MAX_OPS', DEFAULT_MAX_PATCH_OPS))
+        self.maxConcurrency = max_concurrency or int(os.environ.get('DB_MAX_CONCURRENCY', 8))
+
+        if self.dbbaseUrl is None or self.dbscimToken is None:
+            logging.error("Please set DB_BASE_URL and DB_SCIM_TOKEN environment variables")
+            exit(1)
+
+        self._session = None
+        self._semaphore = None
+        self.governor = governor or get_governor("scim")
+
+        '''
+        Optional RunMetrics receiving the count and latency of every request
+        '''
+        self.metrics = None
+
+    '''
+    The session and semaphore are created lazily so they bind to the running event loop
+    '''
+
+    @property
+    def session(self):
+        if self._session is None:
+            self._session = httpx.AsyncClient(
+                headers={'Authorization': 'Bearer ' + self.dbscimToken},
+                limits=httpx.Limits(max_connections=self.maxConcurrency,
+                                    max_keepalive_connections=self.maxConcurrency),
+                timeout=httpx.Timeout(60.0)
+            )
+        return self._session
+
+    '''
+    Send a request through the rate governor, every attempt holds one of the max_concurrency slots
+    while it is in flight, not while it waits to be retried. POST creates are not idempotent, the governor
+    only retries them when the service did not process them
+    '''
+
+    async def _request(self, method, url, **kwargs):
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.maxConcurrency)
+
+        async def send():
+            async with self._semaphore:
+                start = time.perf_counter()
+                # Recorded as an error when the request gets no response, e.g. a timeout or a refused connection
+                status = "error"
+                try:
+                    response = await self.session.request(method, url, **kwargs)
+                    status = response.status_code
+                    return response
+                finally:
+                    if self.metrics is not None:
+                        self.metrics.observe_request("scim", self._endpoint(method, url),
+                                                     time.perf_counter() - start, status)
+
+        return await self.governor.call(send, self.metrics, idempotent=method != "POST")
+
+    '''
+    Endpoint template of a request for metrics, resource ids are replaced by {id}
+    '''
+
+    def _endpoint(self, method, url):
+        segments = url[len(self.dbbaseUrl):].split("?", 1)[0].strip("/").split("/")
+        if len(segments) > 1:
+            segments[1] = "{id}"
+        return method + " /" + "/".join(segments)
+
+    '''
+    Close the pooled connections
+    '''
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.aclose()
+            self._session = None
+
+    '''
+    Iterate over every resource of a SCIM list endpoint, one page in memory at a time.
+    The next page is requested while the current one is consumed
+    '''
+
+    async def _iter_pages(self, api_url, params=None):
+        params = dict(params or {})
+
+        async def get_page(start_index):
+            response = await self._request("GET", api_url,
+                                           params={**params, 'startIndex': start_index, 'count': PAGE_SIZE})
+            return check_response(response, "Listing " + api_url).json()
+
+        start_index = 1
+        seen = 0
+        next_page = asyncio.ensure_future(get_page(start_index))
+        try:
+            while next_page is not None:
+                page = await next_page
+                resources = page.get('Resources', [])
+                seen += len(resources)
+
+                next_page = None
+                if resources and seen < page.get('totalResults', seen):
+                    start_index += PAGE_SIZE
+                    next_page = asyncio.ensure_future(get_page(start_index))
+
+                for resource in resources:
+                    yield resource
+        finally:
+            if next_page is not None:
+                next_page.cancel()
+
+    '''
+    Iterate over the users on Databricks
+    attributes : SCIM attributes to return, by default only the ones the sync needs
+    '''
+
+    def iter_dbusers(self, attributes=USER_ATTRIBUTES):
+        params = {'attributes': attributes} if attributes else None
+        return self._iter_pages(self.dbbaseUrl + "/Users", params)
+
+    '''
+    Iterate over the groups on Databricks
+    attributes : SCIM attributes to return, by default only the ones the sync needs
+    '''
+
+    def iter_dbgroups(self, attributes=GROUP_ATTRIBUTES):
+        params = {'attributes': attributes} if attributes else None
+        return self._iter_pages(self.dbbaseUrl + "/Groups", params)
+
+    '''
+    Look up a Databricks user by user name, None when it does not exist
+    '''
+
+    async def find_dbuser(self, user_name):
+        return await self._find(self.dbbaseUrl + "/Users", f"userName eq \"{user_name}\"", USER_ATTRIBUTES)
+
+    '''
+    Look up a Databricks group by display name, None when it does not exist
+    '''
+
+    async def find_dbgroup(self, display_name):
+        return await self._find(self.dbbaseUrl + "/Groups", f"displayName eq \"{display_name}\"", "id,displayName")
+
+    async def _find(self, api_url, scim_filter, attributes):
+        response = await self._request("GET", api_url, params={'filter': scim_filter, 'attributes': attributes})
+        resources = check_response(response, "Looking up " + scim_filter).json().get('Resources', [])
+        return resources[0] if resources else None
+
+    '''
+    Create Databricks User
+    Returns the created SCIM resource, the existing one when the user already exists, None on dry run or failure
+    '''
+
+    async def create_dbuser(self, user, dryrun):
+        api_url = self.dbbaseUrl + "/Users"
+
+        if not dryrun:
+            response = await self._request("POST", api_url, content=json.dumps(user_payload(user)))
+            if is_conflict(response.status_code, response.text):
+                logging.info(f"User {user[1]} already exists, using the existing user")
+                return await self.find_dbuser(user[1])
+            logging.debug("Response was :" + response.text)
+            resource = created_resource(response, "user " + str(user[1]))
+            if resource is not None:
+                logging.info("User created " + str(user[1]))
+            return resource
+        else:
+            logging.info("User to be created " + str(user[0]))
+
+    '''
+    Create an empty Databricks group
+    Returns the created SCIM resource, the existing one when the group already exists, None on dry run or failure
+    '''
+
+    async def create_blank_dbgroup(self, group, dryrun):
+        api_url = self.dbbaseUrl + "/Groups"
+
+        ujson = json.dumps(group_payload(group))
+        if not dryrun:
+            response = await self._request("POST", api_url, content=ujson)
+            if is_conflict(response.status_code, response.text):
+                logging.info(f"Group {group} already exists, using the existing group")
+                return await self.find_dbgroup(group)
+            logging.debug("Blank Group Created.Request was " + ujson)
+            logging.debug("Response was :" + response.text)
+            return created_resource(response, "group " + group)
+        else:
+            logging.debug("Blank Group to be created :" + group)
+
+    '''
+    Add and remove members of a Databricks group by id, the PatchOp requests are sent in order
+    '''
+
+    async def patch_dbgroup_members(self, gid, add_ids, remove_ids):
+        api_url = self.dbbaseUrl + "/Groups/" + gid
+
+        for gdata in build_patch_requests(add_ids, remove_ids, self.maxPatchOps):
+            ujson = json.dumps(gdata)
+            response = check_response(await self._request("PATCH", api_url, content=ujson), "Patching group " + gid)
+            log_patch_request(gid, ujson, response)
+
+    '''
+    Send a SCIM /Bulk request
+    operations : list of bulk operations with method, path, bulkId and data
+    fail_on_errors : number of errors after which the service stops processing the request, None to not set it
+    Returns the HTTP response
+    '''
+
+    async def post_bulk(self, operations, fail_on_errors=None):
+        api_url = self.dbbaseUrl + "/Bulk"
+        u = {
+            "schemas": [
+                "urn:ietf:params:scim:api:messages:2.0:BulkRequest"
+            ],
+            "Operations": operations
+        }
+        if fail_on_errors is not None:
+            u["failOnErrors"] = fail_on_errors
+
+        return await self._request("POST", api_url, content=json.dumps(u))
+
+    '''
+    Delete a Databricks User
+    '''
+
+    async def delete_user(self, uid):
+        api_url = self.dbbaseUrl + "/Users/" + uid
+        return check_response(await self._request("DELETE", api_url), "Deleting user " + uid).text
+
+    '''
+    Delete a Databricks group
+    '''
+
+    async def delete_group(self, uid, dryrun):
+        api_url = self.dbbaseUrl + "/Groups/" + uid
+
+        if not dryrun:
+            return check_response(await self._request("DELETE", api_url), "Deleting group " + uid).text
@@ -0,0 +1,257 @@
+import argparse
+import functools
+import json
+import logging
+import os
+import sys
+from types import MappingProxyType
+
+'''
+Command line entry point of the package: nestedaaddb sync|dry-run|plan|apply|show|daemon.
+Only the modules a command needs are imported when it runs, so plan inspection never loads the Graph,
+Azure identity or HTTP client stacks and apply never loads the Graph ones
+'''
+
+'''
+Settings of the commands: name to (environment variable, type, default).
+They are resolved from the defaults, the optional JSON file named by NESTEDAADDB_CONFIG or --config,
+then the environment, command line options override them
+'''
+SETTINGS = {
+    "graph_concurrency": ("GRAPH_MAX_CONCURRENCY", int, 10),
+    "graph_traversal": ("GRAPH_TRAVERSAL", str, "recursive"),
+    "db_concurrency": ("DB_MAX_CONCURRENCY", int, None),
+    "bulk_batch_size": ("DB_BULK_BATCH_SIZE", int, 100),
+    "diff_workers": ("SYNC_DIFF_WORKERS", int, None),
+    "targets": ("SYNC_TARGETS", str, None),
+    "metrics_json": ("SYNC_METRICS_JSON", str, None),
+    "metrics_textfile": ("SYNC_METRICS_TEXTFILE", str, None),
+    "log_level": ("SYNC_LOG_LEVEL", str, "INFO"),
+}
+
+
+'''
+Resolve the settings once per process and configuration file, later calls return the cached result
+'''
+
+
+@functools.lru_cache(maxsize=None)
+def load_config(path=None):
+    config = {name: default for name, (_, _, default) in SETTINGS.items()}
+
+    path = path or os.environ.get("NESTEDAADDB_CONFIG")
+    if path:
+        with open(path) as f:
+            values = json.load(f)
+        unknown = set(values) - set(SETTINGS)
+        if unknown:
+            raise ValueError(f"Unknown settings in {path}: {', '.join(sorted(unknown))}")
+        config.update(values)
+
+    for name, (env, cast, _) in SETTINGS.items():
+        if os.environ.get(env):
+            config[name] = cast(os.environ[env])
+
+    return MappingProxyType(config)
+
+
+def _settings(args):
+    settings = dict(load_config(args.config))
+    settings.update({name: value for name, value in vars(args).items() if name in SETTINGS and value is not None})
+    return settings
+
+
+'''
+Syncer of the settings, a MultiTargetSync when a targets file is given
+'''
+
+
+def _syncer(settings):
+    if settings["targets"]:
+        from nestedaaddb.multi_target import MultiTargetSync, load_targets
+
+        return MultiTargetSync(load_targets(settings["targets"]), graph_concurrency=settings["graph_concurrency"],
+                               bulk_batch_size=settings["bulk_batch_size"],
+                               graph_traversal=settings["graph_traversal"], metrics_json=settings["metrics_json"],
+                               metrics_textfile=settings["metrics_textfile"])
+
+    from nestedaaddb.nested_groups import SyncNestedGroups
+
+    return SyncNestedGroups(graph_concurrency=settings["graph_concurrency"],
+                            db_concurrency=settings["db_concurrency"], bulk_batch_size=settings["bulk_batch_size"],
+                            metrics_json=settings["metrics_json"], metrics_textfile=settings["metrics_textfile"],
+                            graph_traversal=settings["graph_traversal"], diff_workers=settings["diff_workers"])
+
+
+'''
+Run a coroutine of the syncer and close its connections
+'''
+
+
+def _run(syncer, command):
+    import asyncio
+
+    async def run():
+        try:
+            return await command(syncer)
+        finally:
+            await syncer.close()
+
+    return asyncio.run(run())
+
+
+'''
+Exit status of a run report: 1 when an operation or a target failed
+'''
+
+
+def _status(report):
+    failed = report.get("principals", {}).get("operations_failed")
+    failed_targets = [name for name, target in report.get("targets", {}).items() if "error" in target]
+    return 1 if failed or failed_targets else 0
+
+
+def cmd_sync(args, settings, dryrun=False):
+    report = _run(_syncer(settings), lambda syncer: syncer.sync_many(args.groups, dryrun, args.consistency_check))
+    print(json.dumps(report, indent=2))
+    return _status(report)
+
+
+def cmd_dry_run(args, settings):
+    return cmd_sync(args, settings, dryrun=True)
+
+
+def cmd_plan(args, settings):
+    if settings["targets"]:
+        raise SystemExit("plan computes the plan of a single Databricks target, it does not take --targets")
+
+    plan = _run(_syncer(settings), lambda syncer: syncer.plan(args.groups, args.output))
+    _print_plan(plan, args.output, show_ops=args.output is None)
+    return 0
+
+
+def cmd_apply(args, settings):
+    if settings["targets"]:
+        raise SystemExit("apply applies a plan to a single Databricks target, it does not take --targets")
+
+    report = _run(_syncer(settings), lambda syncer: syncer.apply(args.plan, args.checkpoint, args.workers))
+    print(json.dumps(report, indent=2))
+    return _status(report)
+
+
+def cmd_show(args, settings):
+    from nestedaaddb.sync_plan import SyncPlan, Checkpoint
+
+    plan = SyncPlan.load(args.plan)
+    done = set()
+    checkpoint_file = args.checkpoint or args.plan + ".checkpoint"
+    if os.path.exists(checkpoint_file):
+        done = Checkpoint(checkpoint_file, plan, read_only=True).done
+
+    _print_plan(plan, args.plan, show_ops=args.ops or args.group is not None, group=args.group, done=done)
+    return 0
+
+
+def cmd_daemon(args, settings):
+    import asyncio
+    from nestedaaddb.daemon import SyncDaemon
+
+    daemon = SyncDaemon(args.groups, args.interval, args.jitter, args.full_sync_every, args.report_file,
+                        _syncer(settings), args.dryrun, args.consistency_check)
+    asyncio.run(daemon.run(args.cycles))
+    return 0
+
+
+def _print_plan(plan, source, show_ops=False, group=None, done=()):
+    print(f"Plan {source or ''} of {', '.join(plan.toplevelgroups)}: {len(plan.ops)} operations, "
+          f"{len(done)} applied")
+    for op, count in sorted(plan.summary().items()):
+        print(f"  {op:<13} {count}")
+
+    if not show_ops:
+        return
+    for op in plan.ops:
+        if group is not None and op["displayName"].casefold() != group.casefold():
+            continue
+        status = "done" if op["seq"] in done else "todo"
+        line = f"{op['seq']:>6} {status} {op['op']:<13} {op['displayName']}"
+        if op["op"] == "patch_group":
+            line += f" +{len(op['add'])} -{len(op['remove'])}"
+        print(line)
+
+
+def _parser():
+    parser = argparse.ArgumentParser(prog="nestedaaddb", description="Sync nested AAD groups to Databricks")
+    parser.add_argument("--config", help="JSON file of settings, defaults to NESTEDAADDB_CONFIG")
+    parser.add_argument("--log-level", help="logging level, defaults to SYNC_LOG_LEVEL or INFO")
+    commands = parser.add_subparsers(dest="command", metavar="command")
+    commands.required = True
+
+    def syncer_options(command):
+        command.add_argument("--graph-concurrency", type=int, help="concurrent Graph requests")
+        command.add_argument("--graph-traversal", choices=("recursive", "transitive"))
+        command.add_argument("--db-concurrency", type=int, help="concurrent Databricks SCIM requests")
+        command.add_argument("--bulk-batch-size", type=int, help="creates per SCIM /Bulk request")
+        command.add_argument("--diff-workers", type=int, help="processes computing the membership diffs")
+        command.add_argument("--metrics-json", help="file the run report is written to as JSON")
+        command.add_argument("--metrics-textfile", help="file the run report is written to as a Prometheus textfile")
+
+    for name, handler, description in (("sync", cmd_sync, "sync top level groups to Databricks"),
+                                       ("dry-run", cmd_dry_run, "log the changes a sync would make")):
+        command = commands.add_parser(name, help=description)
+        command.add_argument("groups", nargs="+", help="top level AAD groups")
+        command.add_argument("--consistency-check", action="store_true",
+                             help="read Databricks again after the sync and apply what is left")
+        command.add_argument("--targets", help="JSON file of the Databricks targets, defaults to SYNC_TARGETS")
+        syncer_options(command)
+        command.set_defaults(handler=handler)
+
+    command = commands.add_parser("plan", help="compute the plan of a sync without changing Databricks")
+    command.add_argument("groups", nargs="+", help="top level AAD groups")
+    command.add_argument("-o", "--output", help="file the plan is written to, the operations are listed otherwise")
+    syncer_options(command)
+    command.set_defaults(handler=cmd_plan)
+
+    command = commands.add_parser("apply", help="apply a plan file")
+    command.add_argument("plan", help="plan file written by plan")
+    command.add_argument("--checkpoint", help="checkpoint file, defaults to the plan file with .checkpoint appended")
+    command.add_argument("--workers", type=int, help="operations applied concurrently")
+    syncer_options(command)
+    command.set_defaults(handler=cmd_apply)
+
+    command = commands.add_parser("show", help="inspect a plan file and the progress of its apply")
+    command.add_argument("plan", help="plan file written by plan")
+    command.add_argument("--checkpoint", help="checkpoint file, defaults to the plan file with .checkpoint appended")
+    command.add_argument("--ops", action="store_true", help="list the operations")
+    command.add_argument("--group", help="only list the operations of a group")
+    command.set_defaults(handler=cmd_show)
+
+    from nestedaaddb.daemon import DEFAULT_FULL_SYNC_EVERY
+
+    command = commands.add_parser("daemon", help="run syncs on a schedule")
+    command.add_argument("groups", nargs="+", help="top level AAD groups")
+    command.add_argument("--interval", type=float, default=900, help="seconds between cycles")
+    command.add_argument("--jitter", type=float, default=0.1, help="fraction of the interval added or removed")
+    command.add_argument("--full-sync-every", type=int, default=DEFAULT_FULL_SYNC_EVERY,
+                         help="cycles between full syncs, 0 to only follow the AAD delta")
+    command.add_argument("--report-file", help="JSON Lines file the report of every cycle is appended to")
+    command.add_argument("--cycles", type=int, help="stop after that many cycles")
+    command.add_argument("--dryrun", action="store_true")
+    command.add_argument("--consistency-check", action="store_true",
+                         help="read Databricks again after every sync and apply what is left")
+    command.add_argument("--targets", help="JSON file of the Databricks targets, defaults to SYNC_TARGETS")
+    syncer_options(command)
+    command.set_defaults(handler=cmd_daemon)
+
+    return parser
+
+
+def main(argv=None):
+    args = _parser().parse_args(argv)
+    settings = _settings(args)
+    logging.basicConfig(level=settings["log_level"].upper())
+    return args.handler(args, settings)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
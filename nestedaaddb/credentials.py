@@ -0,0 +1,39 @@
+import threading
+import time
+
+'''
+Token caching for long running processes.
+Some credentials of the DefaultAzureCredential chain, e.g. the Azure CLI one, acquire a new token on every call.
+CachedTokenCredential hands out the last token of each scope set until shortly before it expires
+'''
+
+'''
+Seconds before expiry at which a cached token is refreshed
+'''
+REFRESH_MARGIN = 300
+
+
+class CachedTokenCredential:
+
+    def __init__(self, credential, refresh_margin=REFRESH_MARGIN):
+        self.credential = credential
+        self.refresh_margin = refresh_margin
+        self._tokens = {}
+        self._lock = threading.Lock()
+
+    def get_token(self, *scopes, **kwargs):
+        # Claims challenges and tenant overrides always go to the wrapped credential
+        if kwargs.get("claims") or kwargs.get("tenant_id"):
+            return self.credential.get_token(*scopes, **kwargs)
+
+        key = tuple(sorted(scopes))
+        with self._lock:
+            token = self._tokens.get(key)
+            if token is None or token.expires_on - self.refresh_margin <= time.time():
+                token = self._tokens[key] = self.credential.get_token(*scopes, **kwargs)
+            return token
+
+    def close(self):
+        close = getattr(self.credential, "close", None)
+        if close is not None:
+            close()
@@ -0,0 +1,147 @@
+import asyncio
+import json
+import logging
+import random
+import signal
+import sys
+import time
+from collections import deque
+
+'''
+Long running sync scheduler.
+The Graph and Databricks clients, their connections and tokens are created once and reused by every cycle,
+and the resolved AAD hierarchies are kept in memory so a cycle only refetches the groups changed since the last one.
+The syncers are imported when the daemon is created, so the command line can read DEFAULT_FULL_SYNC_EVERY cheaply
+'''
+
+'''
+Cycles between two full syncs. Cycles without AAD changes do not read Databricks, the full syncs reconcile
+changes made there by hand
+'''
+DEFAULT_FULL_SYNC_EVERY = 24
+
+
+class SyncDaemon:
+    '''
+    toplevelgroups : top level groups synced every cycle
+    interval : seconds between the starts of two cycles
+    jitter : fraction of the interval randomly added or removed, so many daemons do not hit the services together
+    full_sync_every : every that many cycles the hierarchies are fetched again in full and Databricks is reconciled,
+    0 or None to only follow the delta
+    report_file : optional JSON Lines file the run report of every cycle is appended to
+    syncer : optional preconfigured SyncNestedGroups or MultiTargetSync
+    dryrun, consistency_check : passed to every sync
+    '''
+
+    def __init__(self, toplevelgroups, interval=900, jitter=0.1, full_sync_every=DEFAULT_FULL_SYNC_EVERY,
+                 report_file=None, syncer=None, dryrun=False, consistency_check=False):
+        if isinstance(toplevelgroups, str):
+            toplevelgroups = [toplevelgroups]
+        self.toplevelgroups = list(toplevelgroups)
+        self.interval = interval
+        self.jitter = jitter
+        self.full_sync_every = full_sync_every
+        self.report_file = report_file
+        if syncer is None:
+            from nestedaaddb.nested_groups import SyncNestedGroups
+
+            syncer = SyncNestedGroups()
+        self.syncer = syncer
+        self.dryrun = dryrun
+        self.consistency_check = consistency_check
+
+        self.cycle = 0
+        '''
+        Run reports of the last cycles, newest last
+        '''
+        self.reports = deque(maxlen=100)
+        self._stop = None
+
+    '''
+    Run one sync cycle, errors are logged and reported instead of stopping the daemon
+    Returns the run report of the cycle
+    '''
+
+    async def run_cycle(self):
+        self.cycle += 1
+        if self.full_sync_every and self.cycle % self.full_sync_every == 0:
+            logging.info(f"Cycle {self.cycle}: full sync")
+            self.syncer.snapshot = None
+
+        started = time.time()
+        try:
+            report = await self.syncer.sync_many(self.toplevelgroups, self.dryrun, self.consistency_check,
+                                                 incremental=True)
+        except Exception as e:
+            logging.exception(f"Cycle {self.cycle} failed")
+            report = {"error": f"{type(e).__name__}: {e}"}
+
+        report["cycle"] = self.cycle
+        report["started"] = started
+        self.reports.append(report)
+
+        if self.report_file:
+            with open(self.report_file, "a") as f:
+                f.write(json.dumps(report) + "\n")
+
+        logging.info(f"Cycle {self.cycle} finished in {time.time() - started:.1f}s: "
+                     f"{report.get('principals', report.get('error'))}")
+        return report
+
+    '''
+    Delay before the next cycle, measured from the start of the cycle that just ran
+    '''
+
+    def next_delay(self, elapsed):
+        interval = self.interval * (1 + random.uniform(-self.jitter, self.jitter))
+        return max(0.0, interval - elapsed)
+
+    '''
+    Run cycles until stop is called, SIGINT or SIGTERM is received or the number of cycles is reached
+    '''
+
+    async def run(self, cycles=None):
+        self._stop = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            try:
+                loop.add_signal_handler(sig, self.stop)
+            except (NotImplementedError, RuntimeError):
+                # Signal handlers are only available on the main thread of Unix event loops
+                pass
+
+        try:
+            while not self._stop.is_set():
+                start = time.perf_counter()
+                await self.run_cycle()
+                if cycles is not None and self.cycle >= cycles:
+                    break
+
+                delay = self.next_delay(time.perf_counter() - start)
+                logging.info(f"Next cycle in {delay:.0f}s")
+                try:
+                    await asyncio.wait_for(self._stop.wait(), timeout=delay)
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            await self.syncer.close()
+
+    def stop(self):
+        logging.info("Stopping after the current cycle")
+        if self._stop is not None:
+            self._stop.set()
+
+
+'''
+Entry point of python -m nestedaaddb.daemon, the same as nestedaaddb daemon
+'''
+
+
+def main(argv=None):
+    from nestedaaddb import cli
+
+    return cli.main(["daemon"] + list(sys.argv[1:] if argv is None else argv))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
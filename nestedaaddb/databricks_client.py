@@ -1,7 +1,9 @@
 import json
-import requests
 import os
 import logging
+from nestedaaddb.throttle import get_governor
+from nestedaaddb.membership_diff import DEFAULT_MAX_PATCH_OPS, compute_membership_diff, resolve_member_ids, \
+    build_patch_requests, summarize_membership_diff, log_membership_diff
 
 '''
 Databricks client to interact with Databricks SCIM API's
@@ -9,78 +11,214 @@ https://docs.databricks.com/dev-tools/api/latest/scim/account-scim.html
 '''
 
 
+'''
+Page size used when listing users and groups
+'''
+PAGE_SIZE = 10000
+
+'''
+Attributes requested by the streaming readers, only what the sync needs
+'''
+USER_ATTRIBUTES = "id,userName"
+GROUP_ATTRIBUTES = "id,displayName,members"
+
+
+'''
+SCIM payload of a new Databricks user, user is a (display name, user principal name) tuple from AAD
+'''
+
+
+def user_payload(user):
+    return {
+        "schemas": [
+            "urn:ietf:params:scim:schemas:core:2.0:User",
+            "urn:ietf:params:scim:schemas:core:2.0:User"
+        ],
+        "userName": user[1],
+        "displayName": user[0]
+    }
+
+
+'''
+SCIM payload of a new empty Databricks group
+'''
+
+
+def group_payload(group):
+    return {
+        "displayName": group,
+        "schemas": [
+            "urn:ietf:params:scim:schemas:core:2.0:Group"
+        ]
+    }
+
+
+'''
+Error raised when a Databricks SCIM request fails, status_code is the HTTP status of the response
+'''
+
+
+class DatabricksRequestError(Exception):
+    def __init__(self, message, status_code=None):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+'''
+Raise DatabricksRequestError when a request failed, so a failed read or write never goes unnoticed
+'''
+
+
+def check_response(response, action):
+    if response.status_code >= 400:
+        logging.error(f"{action} failed with status {response.status_code}: {response.text}")
+        raise DatabricksRequestError(f"{action} failed with status {response.status_code}", response.status_code)
+    return response
+
+
+'''
+Log a sent PatchOp request and its response at DEBUG.
+The body lists every added and removed member, so it is only formatted when DEBUG is enabled
+'''
+
+
+def log_patch_request(gid, ujson, response):
+    if logging.root.isEnabledFor(logging.DEBUG):
+        logging.debug("Group %s membership updated. Request was : %s", gid, ujson)
+        logging.debug("Response was : %s", response.text)
+
+
+'''
+Whether a create was rejected because the principal already exists.
+Databricks answers 409, other SCIM services flag it with the uniqueness scimType or in the error detail.
+detail : error body of the response, as text or as the parsed JSON
+'''
+
+
+def is_conflict(status, detail=None):
+    if status == 409:
+        return True
+    if status < 400 or detail is None:
+        return False
+    text = (detail if isinstance(detail, str) else json.dumps(detail)).casefold()
+    return '"uniqueness"' in text or "already exists" in text
+
+
+'''
+SCIM resource returned by a create call, None when the service rejected it
+principal : name of the created user or group in the error logged on failure
+'''
+
+
+def created_resource(response, principal):
+    if response.status_code >= 400:
+        logging.error(f"Creating {principal} failed with status {response.status_code}: {response.text}")
+        return None
+    return response.json()
+
+
 class DatabricksClient:
     dbbaseUrl: str
     dbscimToken: str
+    maxPatchOps: int
 
-    def __init__(self):
-        self.dbbaseUrl = os.environ.get('DB_BASE_URL')
-        self.dbscimToken = os.environ.get('DB_SCIM_TOKEN')
+    '''
+    governor : optional rate governor, by default the one shared by every client of the SCIM service
+    base_url, scim_token : SCIM endpoint and token, by default read from DB_BASE_URL and DB_SCIM_TOKEN
+    '''
+
+    def __init__(self, max_patch_ops=None, governor=None, base_url=None, scim_token=None):
+        self.dbbaseUrl = base_url or os.environ.get('DB_BASE_URL')
+        self.dbscimToken = scim_token or os.environ.get('DB_SCIM_TOKEN')
+        self.maxPatchOps = max_patch_ops or int(os.environ.get('DB_PATCH_MAX_OPS', DEFAULT_MAX_PATCH_OPS))
 
         if self.dbbaseUrl is None or self.dbscimToken is None:
             logging.error("Please set DB_BASE_URL and DB_SCIM_TOKEN environment variables")
             exit(1)
 
+        '''
+        A single session keeps connections alive between calls
+        '''
+        # Imported here so the async client and plan tooling sharing this module do not load requests
+        import requests
+
+        self.session = requests.Session()
+        self.session.headers.update({'Authorization': 'Bearer ' + self.dbscimToken})
+        self.governor = governor or get_governor("scim")
+
     '''
-    Get all the users on Databricks
+    Send a request through the rate governor, throttled and failed requests are retried.
+    POST creates are only retried when the service did not process them
     '''
 
-    def get_dbusers(self):
+    def _request(self, method, url, **kwargs):
+        return self.governor.call_blocking(lambda: self.session.request(method, url, **kwargs),
+                                           idempotent=method != "POST")
 
-        # api_url = self.dbbaseUrl + "/Users"
-        #
-        # my_headers = {'Authorization': 'Bearer ' + self.dbscimToken}
-        # response = requests.get(api_url, headers=my_headers).text
-        # return json.loads(response)
-        all_users = []
+    '''
+    Iterate over every resource of a SCIM list endpoint, one page in memory at a time
+    '''
 
-        api_url = self.dbbaseUrl + "/Users"
-        start_index=1
-        count=10000
+    def _iter_pages(self, api_url, params=None):
+        start_index = 1
+        seen = 0
 
         while True:
-            my_headers = {'Authorization': 'Bearer ' + self.dbscimToken}
-            params = {
-                'startIndex': start_index,
-                'count': count
-            }
-
-            response = requests.get(api_url, headers=my_headers, params=params).text
-            users_data = json.loads(response)
+            response = self._request("GET", api_url,
+                                     params={**(params or {}), 'startIndex': start_index, 'count': PAGE_SIZE})
+            page = json.loads(check_response(response, "Listing " + api_url).text)
+            resources = page.get('Resources', [])
+            seen += len(resources)
 
-            # Extract users from the current page and add them to the list
-            if 'Resources' in users_data:
-                all_users.extend(users_data['Resources'])
+            yield from resources
 
-            if 'totalResults' in users_data and len(all_users) >= users_data['totalResults']:
-                # If we have retrieved all users, break out of the loop
+            # Stop once every resource has been retrieved
+            if not resources or seen >= page.get('totalResults', seen):
                 break
 
-            start_index += count  # Increment the startIndex for the next request
+            start_index += PAGE_SIZE
+
+    '''
+    Iterate over the users on Databricks
+    attributes : SCIM attributes to return, by default only the ones the sync needs
+    '''
 
-        return all_users
+    def iter_dbusers(self, attributes=USER_ATTRIBUTES):
+        params = {'attributes': attributes} if attributes else None
+        return self._iter_pages(self.dbbaseUrl + "/Users", params)
+
+    '''
+    Iterate over the groups on Databricks
+    attributes : SCIM attributes to return, by default only the ones the sync needs
+    '''
+
+    def iter_dbgroups(self, attributes=GROUP_ATTRIBUTES):
+        params = {'attributes': attributes} if attributes else None
+        return self._iter_pages(self.dbbaseUrl + "/Groups", params)
+
+    '''
+    Get all the users on Databricks
+    '''
+
+    def get_dbusers(self):
+        return list(self._iter_pages(self.dbbaseUrl + "/Users"))
 
     '''
     Create Databricks User
+    Returns the created SCIM resource, None on dry run or failure
     '''
 
     def create_dbuser(self, user, dryrun):
         api_url = self.dbbaseUrl + "/Users"
-        u = {
-            "schemas": [
-                "urn:ietf:params:scim:schemas:core:2.0:User",
-                "urn:ietf:params:scim:schemas:core:2.0:User"
-            ],
-            "userName": user[1],
-            "displayName": user[0]
-        }
-
-        my_headers = {'Authorization': 'Bearer ' + self.dbscimToken}
+        u = user_payload(user)
 
         if not dryrun:
-            response = requests.post(api_url, data=json.dumps(u), headers=my_headers)
-            logging.info("User created " + str(user[1]))
+            response = self._request("POST", api_url, data=json.dumps(u))
             logging.debug("Response was :" + response.text)
+            resource = created_resource(response, "user " + str(user[1]))
+            if resource is not None:
+                logging.info("User created " + str(user[1]))
+            return resource
         else:
             logging.info("User to be created " + str(user[0]))
 
@@ -88,180 +226,43 @@ class DatabricksClient:
     Add or remove users in Databricks group
     members : all the users/group that should be in the final state of the group.This is retrieved from Azure AAD
     dbg : databricks group with id and membership
-    dbus: all databricks users
-    dbgroups : all databricks groups
+    directory : DatabricksDirectory index of all databricks users and groups
     '''
 
-    def patch_dbgroup(self, dbg, members, dbus, dbgroups, dryrun):
+    def patch_dbgroup(self, dbg, members, directory, dryrun):
         api_url = self.dbbaseUrl + "/Groups/" + dbg["id"]
-        u = {
-            "schemas": [
-                "urn:ietf:params:scim:api:messages:2.0:PatchOp"
-            ]
-        }
-
-        toadd = []
-        toremove = []
-
-        if members:
-            for member in members:
-                logging.info("-----1m-----")
-                logging.debug(member)
-                exists = False
-                if "members" in dbg:
-                    for dbmember in dbg["members"]:
-                        '''
-                        If it is user we are storing both name and email
-                        If group we only store name
-                        check if user or group exists
-                        '''
-
-                        # Retrieve username from db user within dbus matching on dbu["id"] and dbmember["value"]
-                        username_add = ""
-                        for dbu in dbus:
-                            if dbu["id"] == dbmember["value"]:
-                                username_add = dbu["userName"]
-                                break
-                        
-                        logging.info(f"dbm is {dbmember}")
-
-                        # Note that dbmember response is coming from databricks group api calls which gives members
-                        # This does not have member email-only display
-                        # The display/user name of user in AAD and Databricks must match
-                        # Even if not matched it will just be added to the to add list
-                        if (member["type"] == "user" and member["user_principal_name"].casefold() == username_add.casefold()) \
-                                or (member["type"] == "group" and member["display_name"].casefold() == dbmember["display"].casefold()):
-                            exists = True
-                            logging.info("-----2m")
-                            logging.debug(member)
-                            break
-                if not exists:
-                    logging.info("-----3m")
-                    logging.debug(member)
-                    toadd.append(member)
-
-        if "members" in dbg:
-            for dbmember in dbg["members"]:
-                exists = False
-                
-                # Retrieve username from db user within dbus matching on dbu["id"] and dbmember["value"]
-                username_remove = ""
-                for dbu in dbus:
-                    if dbu["id"] == dbmember["value"]:
-                        username_remove = dbu["userName"]
-                        break
-
-                for member in members:
-                    if (member["type"] == "user" and member["user_principal_name"].casefold() == username_remove.casefold()) \
-                            or (member["type"] == "group" and member["display_name"].casefold() == dbmember["display"].casefold()):
-                        exists = True
-                        break
-                if not exists:
-                    toremove.append(dbmember)
-
-        ops = []
-
-        logging.debug("Inside patchop")
+
+        toadd, toremove = compute_membership_diff(members, dbg, directory)
 
         if len(toadd) == 0 and len(toremove) == 0:
             return
 
-        if len(toadd) > 0:
-            dictsub = {'op': "add", 'path': "members", "value": []}
-            
-            for member in toadd:
-
-                logging.info("----15m-----Going to add user in group-----")
-                logging.debug(member)
-
-                # check if it's a user
-                if member["type"] == "user":
-                    for dbu in dbus:
-                        if dbu["userName"].casefold() == member["user_principal_name"].casefold():
-                            dictsub["value"].append({"value": dbu["id"]})
-                            break
-                # or if it is a group
-                elif member["type"] == "group":
-                    for dbgg in dbgroups:
-                        if dbgg.get("displayName", "").casefold() == member["display_name"].casefold():
-                            dictsub["value"].append({"value": dbgg["id"]})
-                            break
-
-            ops.append(dictsub)
-
-        if len(toremove) > 0:
-
-            dictsub = {'op': "remove", 'path': "members", "value": []}
-            for member in toremove:
-                dictsub["value"].append({"value": member["value"]})
-            ops.append(dictsub)
-
-        gdata = json.loads(json.dumps(u))
-        gdata["Operations"] = ops
-        ujson = json.dumps(gdata)
-        my_headers = {'Authorization': 'Bearer ' + self.dbscimToken}
-        if not dryrun:
-            response = requests.patch(api_url, data=ujson, headers=my_headers)
-            logging.info("Group Existed but membership updated. Request was :" + ujson)
-            logging.debug("Response was :" + response.text)
+        log_membership_diff(summarize_membership_diff(dbg.get("displayName", dbg["id"]), toadd, toremove))
 
-        else:
-            logging.info("Group Exists but membership need to be updated for :"
-                  + dbg.get("displayName", "NoNameExist") + ". Request details-> data " + ujson + ",EndPoint :" + api_url)
+        patch_requests = build_patch_requests(resolve_member_ids(toadd, directory),
+                                              [dbmember["value"] for dbmember in toremove],
+                                              self.maxPatchOps)
+
+        for gdata in patch_requests:
+            ujson = json.dumps(gdata)
+            if not dryrun:
+                response = check_response(self._request("PATCH", api_url, data=ujson),
+                                          "Patching group " + dbg["id"])
+                log_patch_request(dbg["id"], ujson, response)
+
+            else:
+                logging.debug("Membership update of %s not sent. Request details-> data %s,EndPoint : %s",
+                              dbg.get("displayName", "NoNameExist"), ujson, api_url)
 
     '''
     Get all Databricks groups
     '''
 
     def get_dbgroups(self, parent_group_name=None):
-        all_groups = []
-
+        params = {}
         if parent_group_name:
-            api_url = f"{self.dbbaseUrl}/Groups?filter=displayName eq \"{parent_group_name}\""
-        else:
-            api_url = f"{self.dbbaseUrl}/Groups"
-
-        start_index=1
-        count=10000
-
-        while True:
-            my_headers = {'Authorization': 'Bearer ' + self.dbscimToken}
-            params = {
-                'startIndex': start_index,
-                'count': count
-            }
-
-            response = requests.get(api_url, headers=my_headers, params=params).text
-            groups_data = json.loads(response)
-
-            # Extract users from the current page and add them to the list
-            if 'Resources' in groups_data:
-                all_groups.extend(groups_data['Resources'])
-
-            if 'totalResults' in groups_data and len(all_groups) >= groups_data['totalResults']:
-                # If we have retrieved all users, break out of the loop
-                break
-
-            start_index += count  # Increment the startIndex for the next request
-
-        return all_groups
-
-    '''
-    Get all nested Databricks groups from Parent
-    '''
-
-    def get_distinct_nested_dbgroups(self, parent_group_name, all_group_names: set = set()):
-        parent_group = self.get_dbgroups(parent_group_name)[0]
-        all_group_names.add((parent_group["id"], parent_group["displayName"]))
-
-        if parent_group.get("members"):
-            for dbmember in parent_group["members"]:
-                if dbmember["$ref"].startswith("Groups/"):
-                    all_group_names.add((dbmember["value"], dbmember["display"]))
-
-                    self.get_distinct_nested_dbgroups(dbmember["display"], all_group_names)
-
-        return all_group_names
+            params['filter'] = f"displayName eq \"{parent_group_name}\""
+        return list(self._iter_pages(self.dbbaseUrl + "/Groups", params))
 
     '''
     Delete a Databricks User
@@ -270,8 +271,7 @@ class DatabricksClient:
     def delete_user(self, uid):
         api_url = self.dbbaseUrl + "/Users/" + uid
 
-        my_headers = {'Authorization': 'Bearer ' + self.dbscimToken}
-        response = requests.delete(api_url, headers=my_headers).text
+        response = check_response(self._request("DELETE", api_url), "Deleting user " + uid).text
         return response
 
     '''
@@ -281,26 +281,22 @@ class DatabricksClient:
     def delete_group(self, uid, dryrun):
         api_url = self.dbbaseUrl + "/Groups/" + uid
 
-        my_headers = {'Authorization': 'Bearer ' + self.dbscimToken}
         if not dryrun:
-            response = requests.delete(api_url, headers=my_headers).text
+            response = check_response(self._request("DELETE", api_url), "Deleting group " + uid).text
             return response
 
+    '''
+    Create an empty Databricks group
+    Returns the created SCIM resource, None on dry run or failure
+    '''
+
     def create_blank_dbgroup(self, group, dryrun):
         api_url = self.dbbaseUrl + "/Groups"
-        u = {
-            "displayName": group,
-            "schemas": [
-                "urn:ietf:params:scim:schemas:core:2.0:Group"
-            ]
-        }
-
-        gdata = json.loads(json.dumps(u))
-        ujson = json.dumps(gdata)
-        my_headers = {'Authorization': 'Bearer ' + self.dbscimToken}
+        ujson = json.dumps(group_payload(group))
         if not dryrun:
-            response = requests.post(api_url, data=ujson, headers=my_headers)
+            response = self._request("POST", api_url, data=ujson)
             logging.debug("Blank Group Created.Request was " + ujson)
             logging.debug("Response was :" + response.text)
+            return created_resource(response, "group " + group)
         else:
             logging.debug("Blank Group to be created :" + group)
\ No newline at end of file
@@ -0,0 +1,146 @@
+import asyncio
+
+'''
+Hash indexed snapshot of the Databricks users and groups.
+It is built once per run so that every existence check and id lookup is a dictionary access
+instead of a scan over all users and groups.
+Only the attributes the sync needs are kept: id and userName of users, id, displayName and
+member value, display and $ref of groups
+'''
+
+
+class DatabricksDirectory:
+
+    def __init__(self, dbusers, dbgroups):
+        self.users_by_name = {}
+        self.users_by_id = {}
+        self.groups_by_name = {}
+        self.groups_by_id = {}
+
+        for dbu in dbusers:
+            self.add_user(dbu)
+
+        for dbg in dbgroups:
+            self.add_group(dbg)
+
+    '''
+    Build the index from the streaming readers of a Databricks client, users and groups are read concurrently
+    and no list of full resources is ever held in memory
+    '''
+
+    @classmethod
+    async def load(cls, dbclient):
+        directory = cls([], [])
+
+        async def load_users():
+            async for dbu in dbclient.iter_dbusers():
+                directory.add_user(dbu)
+
+        async def load_groups():
+            async for dbg in dbclient.iter_dbgroups():
+                directory.add_group(dbg)
+
+        await asyncio.gather(load_users(), load_groups())
+        return directory
+
+    '''
+    Add a user to the index
+    '''
+
+    def add_user(self, dbu):
+        dbu = {"id": dbu["id"], "userName": dbu.get("userName", "")}
+        self.users_by_id[dbu["id"]] = dbu
+        if dbu.get("userName"):
+            self.users_by_name[dbu["userName"].casefold()] = dbu
+
+    '''
+    Add a group to the index
+    '''
+
+    def add_group(self, dbg):
+        dbg = {
+            "id": dbg["id"],
+            "displayName": dbg.get("displayName", ""),
+            "members": [{"value": m["value"], "display": m.get("display", ""), "$ref": m.get("$ref", "")}
+                        for m in dbg.get("members", [])]
+        }
+        self.groups_by_id[dbg["id"]] = dbg
+        if dbg.get("displayName"):
+            self.groups_by_name[dbg["displayName"].casefold()] = dbg
+
+    '''
+    Remove a group from the index
+    '''
+
+    def remove_group(self, gid):
+        dbg = self.groups_by_id.pop(gid, None)
+        if dbg is not None and dbg.get("displayName"):
+            self.groups_by_name.pop(dbg["displayName"].casefold(), None)
+
+    @property
+    def users(self):
+        return self.users_by_id.values()
+
+    @property
+    def groups(self):
+        return self.groups_by_id.values()
+
+    def get_user_by_name(self, user_name):
+        return self.users_by_name.get(user_name.casefold())
+
+    def get_user_by_id(self, uid):
+        return self.users_by_id.get(uid)
+
+    def get_group_by_name(self, display_name):
+        return self.groups_by_name.get(display_name.casefold())
+
+    def get_group_by_id(self, gid):
+        return self.groups_by_id.get(gid)
+
+    def has_user(self, user_name):
+        return user_name.casefold() in self.users_by_name
+
+    def has_group(self, display_name):
+        return display_name.casefold() in self.groups_by_name
+
+    '''
+    Get all nested Databricks groups from Parent, walking the group members of the snapshot by id.
+    Every group is visited once so membership cycles terminate.
+    Returns a set of (id, displayName), empty when the parent group does not exist
+    '''
+
+    def get_distinct_nested_dbgroups(self, parent_group_name):
+        all_group_names = set()
+
+        parent_group = self.get_group_by_name(parent_group_name)
+        if parent_group is None:
+            return all_group_names
+
+        all_group_names.add((parent_group["id"], parent_group["displayName"]))
+        visited = {parent_group["id"]}
+        stack = [parent_group]
+
+        while stack:
+            dbg = stack.pop()
+            for dbmember in dbg["members"]:
+                if not dbmember["$ref"].startswith("Groups/"):
+                    continue
+
+                all_group_names.add((dbmember["value"], dbmember["display"]))
+
+                child = self.groups_by_id.get(dbmember["value"])
+                if child is not None and child["id"] not in visited:
+                    visited.add(child["id"])
+                    stack.append(child)
+
+        return all_group_names
+
+    '''
+    Resolve the userName of a Databricks user id, empty string if it is not a known user
+    '''
+
+    def user_name_of(self, uid):
+        dbu = self.users_by_id.get(uid)
+        if dbu is None:
+            return ""
+        return dbu.get("userName", "")
@@ -1,42 +1,193 @@
-from azure.identity import DefaultAzureCredential
-from msgraph import GraphServiceClient
-from msgraph.generated.groups.groups_request_builder import GroupsRequestBuilder
-from kiota_abstractions.base_request_configuration import RequestConfiguration
 from collections import defaultdict
+from nestedaaddb.throttle import get_governor, parse_retry_after
+from nestedaaddb.credentials import CachedTokenCredential
+from nestedaaddb.membership_graph import MembershipGraph
+import asyncio
+import base64
+import binascii
+import json
+import logging
+import time
 
 '''
 A wrapper for Graph to interact with Graph API's
 https://learn.microsoft.com/en-us/graph/overview
+The msgraph, kiota and azure-identity SDKs take seconds to import, so they are only imported by the code
+that sends requests. Importing this module, e.g. for build_hierarchy, stays cheap
 '''
 
-class HashableDict(dict):
-    def __hash__(self):
-        return hash(frozenset(self.items()))
+'''
+Largest page size accepted by the members endpoint
+'''
+MEMBERS_PAGE_SIZE = 999
+
+'''
+Maximum number of sub-requests in a single JSON $batch call
+'''
+BATCH_MAX_REQUESTS = 20
+
+'''
+Maximum number of values in a single $filter "in" clause on the groups endpoint
+'''
+GROUP_FILTER_MAX_VALUES = 15
+
+'''
+Sub-request statuses retried inside a $batch call and the number of attempts
+'''
+BATCH_RETRY_STATUSES = {429, 500, 502, 503, 504}
+BATCH_MAX_RETRIES = 4
+
+'''
+Error codes Graph answers with when a delta token has expired and a full resync is required
+'''
+DELTA_EXPIRED_CODES = {"syncStateNotFound", "syncStateInvalid", "resyncRequired"}
+
+'''
+Hierarchy traversal engines.
+recursive : walk the hierarchy one level at a time, fetching the direct members of each level
+transitive : list every nested group with one transitiveMembers query, then fetch the direct members
+             of all of them in a single wave
+'''
+TRAVERSAL_ENGINES = ("recursive", "transitive")
+
+
+class DeltaTokenExpiredError(Exception):
+    pass
+
+
+'''
+Group member decoded from a $batch response.
+It exposes the same attributes as the msgraph User and Group models used by the hierarchy extraction
+'''
+
+
+class GraphMember:
+    __slots__ = ("odata_type", "id", "display_name", "user_principal_name")
+
+    def __init__(self, odata_type, id, display_name, user_principal_name=None):
+        self.odata_type = odata_type
+        self.id = id
+        self.display_name = display_name
+        self.user_principal_name = user_principal_name
+
+    @classmethod
+    def from_json(cls, value):
+        return cls(value.get("@odata.type"), value.get("id"), value.get("displayName"),
+                   value.get("userPrincipalName"))
+
+
+'''
+Request configuration of a groups query with the given query parameters, e.g. select, filter and top
+'''
+
+
+def _groups_request_config(**query_parameters):
+    from msgraph.generated.groups.groups_request_builder import GroupsRequestBuilder
+    from kiota_abstractions.base_request_configuration import RequestConfiguration
+
+    return RequestConfiguration(
+        query_parameters=GroupsRequestBuilder.GroupsRequestBuilderGetQueryParameters(**query_parameters)
+    )
+
+
+'''
+GraphServiceClient whose requests are only retried by the rate governor.
+The retry handler of the SDK middleware would otherwise retry 429, 503 and 504 before the governor sees them,
+multiplying the attempts and hiding the throttling from the governor and the metrics.
+auth_provider : kiota authentication provider of the requests
+base_url : optional Graph endpoint, by default the one of the SDK
+'''
+
+
+def create_graph_client(auth_provider, base_url=None):
+    from kiota_http.middleware.options import RetryHandlerOption
+    from msgraph import GraphServiceClient
+    from msgraph.graph_request_adapter import GraphRequestAdapter, options
+    from msgraph_core import GraphClientFactory
+
+    http_client = GraphClientFactory.create_with_default_middleware(options={
+        **options,
+        RetryHandlerOption.get_key(): RetryHandlerOption(max_retries=0, should_retry=False)
+    })
+    adapter = GraphRequestAdapter(auth_provider, http_client)
+    if base_url:
+        adapter.base_url = base_url
+    return GraphServiceClient(request_adapter=adapter)
 
 
 class Graph:
-    client: GraphServiceClient
+    max_concurrency: int
+
+    '''
+    max_concurrency : maximum number of member requests in flight while traversing the hierarchy
+    use_batch : fetch the members of many groups at once with JSON $batch calls
+    client : optional preconfigured GraphServiceClient, see create_graph_client. By default one is created with
+    DefaultAzureCredential on first use, so a Graph that never sends a request never loads the SDK
+    traversal : hierarchy traversal engine, one of TRAVERSAL_ENGINES
+    governor : optional rate governor, by default the one shared by every client of the Graph service
+    '''
 
-    def __init__(self):
-        self.credential = DefaultAzureCredential()
+    def __init__(self, max_concurrency=10, use_batch=True, client=None, traversal="recursive", governor=None):
+        if traversal not in TRAVERSAL_ENGINES:
+            raise ValueError(f"Unknown traversal engine {traversal}, expected one of {TRAVERSAL_ENGINES}")
         self.scopes = ['https://graph.microsoft.com/.default']
-        self.client = GraphServiceClient(credentials=self.credential, scopes=self.scopes)
+        self._client = client
+        self.max_concurrency = max_concurrency
+        self.use_batch = use_batch
+        self.traversal = traversal
+        self.governor = governor or get_governor("graph")
+
+        '''
+        Optional RunMetrics receiving the count and latency of every request
+        '''
+        self.metrics = None
+
+    @property
+    def client(self):
+        if self._client is None:
+            from azure.identity import DefaultAzureCredential
+            from kiota_authentication_azure.azure_identity_authentication_provider import \
+                AzureIdentityAuthenticationProvider
+
+            self.credential = CachedTokenCredential(DefaultAzureCredential())
+            self._client = create_graph_client(AzureIdentityAuthenticationProvider(self.credential,
+                                                                                   scopes=self.scopes))
+        return self._client
+
+    '''
+    Send a Graph request through the rate governor and record the latency of every attempt under the endpoint template
+    request : function returning the awaitable of the request, called again when the request is retried
+    '''
+
+    async def _timed(self, endpoint, request):
+        async def send():
+            start = time.perf_counter()
+            status = "error"
+            try:
+                result = await request()
+                status = 200
+                return result
+            except Exception as e:
+                # Graph APIError carries the status of the failed response, transport errors have none
+                status = getattr(e, "response_status_code", None) or status
+                raise
+            finally:
+                if self.metrics is not None:
+                    self.metrics.observe_request("graph", endpoint, time.perf_counter() - start, status)
+
+        return await self.governor.call(send, self.metrics)
 
     '''
     Initialises the client
     '''
 
     async def get_group_by_name(self, group_name):
-        query_params = GroupsRequestBuilder.GroupsRequestBuilderGetQueryParameters(
+        request_config = _groups_request_config(
             select=['displayName','id'],
             filter=f"displayName eq '{group_name}'"
         )
 
-        request_config = RequestConfiguration(
-            query_parameters=query_params
-        )
-
-        return await self.client.groups.get(request_configuration=request_config)
+        return await self._timed("GET /groups", lambda: self.client.groups.get(request_configuration=request_config))
     
     async def check_group_exists(self, group_name):
         group = await self.get_group_by_name(group_name)
@@ -45,6 +196,52 @@ class Graph:
         else:
             return True
 
+    '''
+    Check the existence of many groups by display name.
+    Names are looked up GROUP_FILTER_MAX_VALUES at a time with displayName in (...) filters sent concurrently.
+    Returns a dictionary of group name to True when the group exists in AAD
+    '''
+
+    async def check_groups_exist(self, group_names):
+        group_names = list(dict.fromkeys(group_names))
+        chunks = [group_names[i:i + GROUP_FILTER_MAX_VALUES]
+                  for i in range(0, len(group_names), GROUP_FILTER_MAX_VALUES)]
+
+        semaphore = asyncio.Semaphore(self.max_concurrency)
+
+        async def bounded(chunk):
+            async with semaphore:
+                return await self._get_group_names_in(chunk)
+
+        found = set()
+        for names in await asyncio.gather(*[bounded(chunk) for chunk in chunks]):
+            found.update(names)
+
+        # displayName filters are case insensitive
+        return {name: name.casefold() in found for name in group_names}
+
+    '''
+    Get the casefolded display names of the groups matching any of the given names
+    '''
+
+    async def _get_group_names_in(self, group_names):
+        values = ",".join("'" + name.replace("'", "''") + "'" for name in group_names)
+        request_config = _groups_request_config(
+            select=['displayName','id'],
+            filter=f"displayName in ({values})",
+            top=MEMBERS_PAGE_SIZE
+        )
+
+        found = set()
+        page = await self._timed("GET /groups", lambda: self.client.groups.get(request_configuration=request_config))
+        while page:
+            found.update(g.display_name.casefold() for g in page.value or [] if g.display_name)
+            if not page.odata_next_link:
+                break
+            page = await self._timed("GET /groups", lambda: self.client.groups.with_url(page.odata_next_link).get())
+
+        return found
+
     '''
     Get all the groups from AAD
     '''
@@ -53,69 +250,413 @@ class Graph:
         return self.get_group_by_name(group_name).value[0].id
 
     async def get_groups(self):
-        query_params = GroupsRequestBuilder.GroupsRequestBuilderGetQueryParameters(
+        request_config = _groups_request_config(
             select=['displayName','id'],
             orderby='displayName'
         )
+        return await self._timed("GET /groups", lambda: self.client.groups.get(request_configuration=request_config))
 
-        request_config = RequestConfiguration(
-            query_parameters=query_params
-        )
-        return await self.client.groups.get(request_configuration=request_config)
+    '''
+    Get a delta link pointing at the current state of the groups, without enumerating the tenant
+    '''
+
+    async def get_latest_delta_link(self):
+        url = f"{self.client.request_adapter.base_url}/groups/delta?$select=displayName,members&$deltatoken=latest"
+        response = await self._timed("GET /groups/delta", lambda: self.client.groups.delta.with_url(url).get())
+        return response.odata_delta_link
 
     '''
-    Get all the group members from the group
+    Get the ids of the groups whose name or members changed since the delta link was issued.
+    Returns the changed group ids and the delta link to use next time.
+    Raises DeltaTokenExpiredError when Graph requires a full resync
+    '''
+
+    async def get_changed_group_ids(self, delta_link):
+        from kiota_abstractions.api_error import APIError
+
+        changed = set()
+        url = delta_link
+
+        while True:
+            try:
+                page = await self._timed("GET /groups/delta", lambda: self.client.groups.delta.with_url(url).get())
+            except APIError as e:
+                error_code = getattr(getattr(e, "error", None), "code", None)
+                if e.response_status_code == 410 or error_code in DELTA_EXPIRED_CODES:
+                    raise DeltaTokenExpiredError(f"Delta token expired: {error_code or e.response_status_code}") from e
+                raise
+
+            changed.update(g.id for g in page.value or [])
+            if not page.odata_next_link:
+                return changed, page.odata_delta_link
+            url = page.odata_next_link
+
+    '''
+    Get all the group members from the group.
+    Every page is followed so large groups are not truncated
     '''
 
     async def get_group_members(self, gid):
-        query_params = GroupsRequestBuilder.GroupsRequestBuilderGetQueryParameters(
-            select=['displayName','id','userPrincipalName']
-        )
+        members_builder = self.client.groups.by_group_id(gid).members
+        page = await self._timed("GET /groups/{id}/members",
+                                 lambda: members_builder.get(request_configuration=self._members_request_config()))
 
-        request_config = RequestConfiguration(
-            query_parameters=query_params
+        members = []
+        while page:
+            members.extend(page.value or [])
+            if not page.odata_next_link:
+                break
+            page = await self._timed("GET /groups/{id}/members",
+                                     lambda: members_builder.with_url(page.odata_next_link).get())
+
+        return members
+
+    def _members_request_config(self):
+        return _groups_request_config(
+            select=['displayName','id','userPrincipalName'],
+            top=MEMBERS_PAGE_SIZE
         )
 
-        return await self.client.groups.by_group_id(gid).members.get(request_configuration=request_config)
+    '''
+    Get the members of many groups.
+    The first pages of up to BATCH_MAX_REQUESTS groups are packed in one $batch call and next pages are
+    requested the same way until every group is complete.
+    Returns a dictionary of group id to list of members
+    '''
+
+    async def get_members_of_groups(self, gids):
+        members = {gid: [] for gid in gids}
+        if not members:
+            return members
+
+        semaphore = asyncio.Semaphore(self.max_concurrency)
+
+        async def bounded(fetch):
+            async with semaphore:
+                return await fetch
+
+        if not self.use_batch:
+            results = await asyncio.gather(*[bounded(self.get_group_members(gid)) for gid in members])
+            return dict(zip(members, results))
+
+        pending = [(gid, None) for gid in members]
+        while pending:
+            chunks = [pending[i:i + BATCH_MAX_REQUESTS] for i in range(0, len(pending), BATCH_MAX_REQUESTS)]
+            results = await asyncio.gather(*[bounded(self._batch_members_pages(chunk)) for chunk in chunks])
+
+            pending = []
+            for pages in results:
+                for gid, page in pages:
+                    members[gid].extend(GraphMember.from_json(value) for value in page.get("value", []))
+                    if page.get("@odata.nextLink"):
+                        pending.append((gid, page["@odata.nextLink"]))
+
+        return members
+
+    '''
+    Fetch one members page for each (group id, next link) in a single $batch call.
+    Throttled or failed sub-requests are retried on their own, honouring Retry-After
+    '''
+
+    async def _batch_members_pages(self, requests):
+        from msgraph_core.requests.batch_request_content import BatchRequestContent
+        from msgraph_core.requests.batch_request_item import BatchRequestItem
+
+        pages = []
+        remaining = list(requests)
+
+        for attempt in range(BATCH_MAX_RETRIES + 1):
+            content = BatchRequestContent()
+            items = {}
+            for gid, next_link in remaining:
+                members_builder = self.client.groups.by_group_id(gid).members
+                if next_link:
+                    request_information = members_builder.with_url(next_link).to_get_request_information()
+                else:
+                    request_information = members_builder.to_get_request_information(self._members_request_config())
+                item = BatchRequestItem(request_information=request_information)
+                content.add_request(item.id, item)
+                items[item.id] = (gid, next_link)
+
+            responses = await self._post_batch(content)
+
+            retry = []
+            retry_after = None
+            for item_id, (gid, next_link) in items.items():
+                item = responses.get(item_id)
+                status = item.get("status") if item else None
+                headers = (item.get("headers") if item else None) or {}
+                if status == 200:
+                    pages.append((gid, self._read_batch_body(item, gid)))
+                elif status is None or status in BATCH_RETRY_STATUSES:
+                    retry.append((gid, next_link))
+                    if self.metrics is not None:
+                        self.metrics.record_retry("graph")
+                        if status == 429:
+                            self.metrics.record_throttle("graph")
+                    delay = parse_retry_after(headers.get("Retry-After") or headers.get("retry-after"))
+                    if delay is not None:
+                        retry_after = max(retry_after or 0, delay)
+                else:
+                    raise RuntimeError(f"Graph members request for group {gid} failed with status {status}")
+
+            if not retry:
+                return pages
+
+            if attempt < BATCH_MAX_RETRIES:
+                # Throttled sub-requests hold back every Graph request, not only this batch
+                if retry_after is not None:
+                    self.governor.bucket.pause(retry_after)
+                delay = self.governor.backoff(attempt, retry_after)
+                logging.warning(f"{len(retry)} Graph batch sub-requests throttled or failed, retrying in {delay:.2f}s")
+                await asyncio.sleep(delay)
+            remaining = retry
+
+        raise RuntimeError(f"Graph members requests for groups {[gid for gid, _ in remaining]} failed "
+                           f"after {BATCH_MAX_RETRIES} retries")
+
+    '''
+    Send a $batch request and decode its response ourselves.
+    The msgraph_core BatchResponseContent reads every sub-response body as bytes, which drops the inline JSON
+    objects Graph returns, so the raw response is parsed instead.
+    Returns a dictionary of sub-request id to sub-response with status, headers and body
+    '''
+
+    async def _post_batch(self, content):
+        request_info = await self.client.batch.to_post_request_information(content)
+
+        raw = await self._timed("POST /$batch",
+                                lambda: self.client.request_adapter.send_primitive_async(request_info, "bytes", None))
+        try:
+            responses = json.loads(raw)["responses"]
+        except (TypeError, ValueError, KeyError) as e:
+            raise RuntimeError(f"Graph $batch response could not be parsed: {e}") from e
+        return {response.get("id"): response for response in responses}
+
+    '''
+    JSON body of a successful sub-response, given inline or base64 encoded.
+    Raises when the body is missing or not a JSON object, an empty page would remove every member of the group
+    '''
+
+    @staticmethod
+    def _read_batch_body(item, gid):
+        body = item.get("body")
+        if isinstance(body, str):
+            try:
+                body = json.loads(base64.b64decode(body, validate=True))
+            except (ValueError, binascii.Error) as e:
+                raise RuntimeError(f"Graph members page of group {gid} could not be decoded: {e}") from e
+        if not isinstance(body, dict):
+            raise RuntimeError(f"Graph members page of group {gid} has no JSON body")
+        return body
 
     '''
     Extract the user and group mapping .
-    This method makes recursive call to get all the group and member relationships even within nested group
+    The hierarchy is walked one level at a time, the members of all groups of a level are fetched together
     '''
 
     async def extract_from_group(self, gid, displayname, groupusermap, usergroupmap):
-        gms = await self.get_group_members(gid)
-        if gms and gms.value:
-            for gm in gms.value:
-                if gm.odata_type == "#microsoft.graph.user":
-                    for gp in str(displayname).split(":"):
-                        groupusermap[gp].add((gm.display_name, gm.user_principal_name))
-                        usergroupmap[(gm.display_name, gm.user_principal_name)].add(gp)
-
-                elif gm.odata_type == "#microsoft.graph.group":
-                    await self.extract_from_group(gm.id, displayname + ":" + gm.display_name, groupusermap,
-                                            usergroupmap)
+        level = [(gid, displayname)]
+        while level:
+            members = await self.get_members_of_groups({group_id for group_id, _ in level})
+
+            next_level = []
+            for group_id, path in level:
+                for gm in members[group_id]:
+                    if gm.odata_type == "#microsoft.graph.user":
+                        for gp in str(path).split(":"):
+                            groupusermap[gp].add((gm.display_name, gm.user_principal_name))
+                            usergroupmap[(gm.display_name, gm.user_principal_name)].add(gp)
+
+                    elif gm.odata_type == "#microsoft.graph.group":
+                        if gm.display_name in str(path).split(":"):
+                            logging.warning(f"Membership cycle detected: '{gm.display_name}' is nested under itself "
+                                            f"through '{path}'. Not following it again")
+                            continue
+                        next_level.append((gm.id, path + ":" + gm.display_name))
+
+            level = next_level
 
         return groupusermap, usergroupmap
 
+    '''
+    Fetch the direct membership of every group nested under a group.
+    The hierarchy is walked breadth first, the members of every group of a level are fetched together
+    (in $batch calls when use_batch is set) with at most max_concurrency requests in flight.
+    Each group is fetched exactly once even when it is nested under several parents.
+    adjacency : optional cache of group id to membership entry, groups found in it are not fetched again
+    Returns a dictionary of group id to {"display_name", "users": [[display name, upn]], "groups": [[id, display name]]}
+    holding every group reachable from gid
+    '''
+
+    async def fetch_group_adjacency(self, gid, displayname, adjacency=None):
+        if self.traversal == "transitive":
+            return await self._fetch_group_adjacency_transitive(gid, displayname, adjacency)
+
+        cached = adjacency or {}
+        result = {}
+        visited = {gid}
+        level = [(gid, displayname)]
+
+        while level:
+            members = await self.get_members_of_groups([group_id for group_id, _ in level if group_id not in cached])
+
+            next_level = []
+            for group_id, group_name in level:
+                if group_id in members:
+                    entry = self._adjacency_entry(group_name, members[group_id])
+                else:
+                    entry = cached[group_id]
+
+                result[group_id] = entry
+                for child_id, child_name in entry["groups"]:
+                    if child_id not in visited:
+                        visited.add(child_id)
+                        next_level.append((child_id, child_name))
+
+            level = next_level
+
+        return result
+
+    '''
+    Membership entry of fetch_group_adjacency for a group and its direct members, other member types are ignored
+    '''
+
+    @staticmethod
+    def _adjacency_entry(group_name, group_members):
+        entry = {"display_name": group_name, "users": [], "groups": []}
+        for gm in group_members:
+            if gm.odata_type == "#microsoft.graph.user":
+                entry["users"].append([gm.display_name, gm.user_principal_name])
+            elif gm.odata_type == "#microsoft.graph.group":
+                entry["groups"].append([gm.id, gm.display_name])
+        return entry
+
+    '''
+    Transitive engine of fetch_group_adjacency.
+    Every group nested under gid is listed server side with transitiveMembers, so the direct members of all
+    of them are fetched in one wave instead of one wave per level of the hierarchy
+    '''
+
+    async def _fetch_group_adjacency_transitive(self, gid, displayname, adjacency=None):
+        cached = adjacency or {}
+        groups = {gid: displayname}
+        groups.update(await self.get_transitive_member_groups(gid))
+
+        members = await self.get_members_of_groups([group_id for group_id in groups if group_id not in cached])
+
+        result = {}
+        for group_id, group_name in groups.items():
+            if group_id in members:
+                entry = self._adjacency_entry(group_name, members[group_id])
+            else:
+                entry = cached[group_id]
+            result[group_id] = entry
+
+        return result
+
+    '''
+    Get every group nested under a group, at any depth.
+    Returns a dictionary of group id to display name
+    '''
+
+    async def get_transitive_member_groups(self, gid):
+        groups_builder = self.client.groups.by_group_id(gid).transitive_members.graph_group
+        request_config = _groups_request_config(
+            select=['displayName','id'],
+            top=MEMBERS_PAGE_SIZE
+        )
+
+        endpoint = "GET /groups/{id}/transitiveMembers/microsoft.graph.group"
+        page = await self._timed(endpoint, lambda: groups_builder.get(request_configuration=request_config))
+
+        groups = {}
+        while page:
+            groups.update((g.id, g.display_name) for g in page.value or [])
+            if not page.odata_next_link:
+                break
+            page = await self._timed(endpoint, lambda: groups_builder.with_url(page.odata_next_link).get())
+
+        return groups
+
+    '''
+    Extract the nested hierarchy under a group.
+    Membership is fetched with fetch_group_adjacency and resolved with build_hierarchy
+    '''
+
     async def extract_children_from_group(self, gid, displayname, distinct_groups: set,
-                                    distinct_users: set, entra_group_parent_map: defaultdict, depth = 0):
-
-        gms = await self.get_group_members(gid)
-        distinct_groups.add(displayname)
-        if gms and gms.value:
-            for gm in gms.value:
-                if gm.odata_type == "#microsoft.graph.user":
-
-                    entra_group_parent_map[displayname].add(
-                        HashableDict({'type': 'user', 'display_name': gm.display_name, 'user_principal_name': gm.user_principal_name})
-                    )
-                    distinct_users.add((gm.display_name, gm.user_principal_name))
-                elif gm.odata_type == "#microsoft.graph.group":
-
-                    entra_group_parent_map[displayname].add(HashableDict({'type': 'group', 'display_name': gm.display_name, depth: depth}))
-                    distinct_groups.add(gm.display_name)
-                    await self.extract_children_from_group(gm.id, gm.display_name, distinct_groups,
-                                                    distinct_users, entra_group_parent_map, depth + 1)
-
-        return distinct_groups, distinct_users, entra_group_parent_map
\ No newline at end of file
+                                    distinct_users: set, entra_group_parent_map: MembershipGraph = None):
+
+        adjacency = await self.fetch_group_adjacency(gid, displayname)
+        return build_hierarchy(gid, adjacency, distinct_groups, distinct_users, entra_group_parent_map)
+
+
+'''
+Resolve the group membership fetched by Graph.fetch_group_adjacency into
+distinct groups, distinct users and the per group member map, a MembershipGraph created when none is given.
+Membership cycles are detected and not followed
+'''
+
+
+def build_hierarchy(gid, adjacency, distinct_groups: set, distinct_users: set,
+                    entra_group_parent_map: MembershipGraph = None):
+
+    if entra_group_parent_map is None:
+        entra_group_parent_map = MembershipGraph()
+
+    distinct_groups.add(adjacency[gid]["display_name"])
+    visited = {gid}
+    parents = defaultdict(set)
+    level = [gid]
+
+    while level:
+        next_level = []
+        for group_id in level:
+            entry = adjacency[group_id]
+            group_name = entry["display_name"]
+
+            member_ids = []
+            for display_name, user_principal_name in entry["users"]:
+                member_ids.append(entra_group_parent_map.user(display_name, user_principal_name))
+                distinct_users.add((display_name, user_principal_name))
+
+            for child_id, child_name in entry["groups"]:
+                member_ids.append(entra_group_parent_map.group(child_name))
+                distinct_groups.add(child_name)
+
+                if child_id in visited:
+                    if child_id == group_id or _is_ancestor(child_id, group_id, parents):
+                        logging.warning(f"Membership cycle detected: '{child_name}' is nested under itself "
+                                        f"through '{group_name}'. Not following it again")
+                    parents[child_id].add(group_id)
+                    continue
+
+                visited.add(child_id)
+                parents[child_id].add(group_id)
+                next_level.append(child_id)
+
+            if member_ids:
+                entra_group_parent_map.add_members(group_name, member_ids)
+
+        level = next_level
+
+    return distinct_groups, distinct_users, entra_group_parent_map
+
+
+'''
+Check whether ancestor_id is reachable from gid by following parent links
+'''
+
+
+def _is_ancestor(ancestor_id, gid, parents):
+    seen = set()
+    stack = [gid]
+    while stack:
+        current = stack.pop()
+        if current == ancestor_id:
+            return True
+        if current in seen:
+            continue
+        seen.add(current)
+        stack.extend(parents.get(current, ()))
+    return False
@@ -0,0 +1,175 @@
+import json
+import logging
+
+'''
+Membership diff engine.
+AAD members and Databricks group members are normalised into comparable keys
+and the adds/removes are computed as set differences
+'''
+
+PATCH_SCHEMA = "urn:ietf:params:scim:api:messages:2.0:PatchOp"
+
+'''
+Default maximum number of member operations sent in a single PatchOp request
+'''
+DEFAULT_MAX_PATCH_OPS = 1000
+
+'''
+Default number of added and removed principals listed in the diff summary of a group
+'''
+DEFAULT_DIFF_SAMPLE_SIZE = 5
+
+
+'''
+Key of a Databricks group member.
+Databricks only returns id and display of members, users are resolved to their userName through the directory
+'''
+
+
+def db_member_key(dbmember, directory):
+    if not dbmember.get("$ref", "").startswith("Groups/"):
+        username = directory.user_name_of(dbmember["value"])
+        if username:
+            return "user", username.casefold()
+    return "group", dbmember.get("display", "").casefold()
+
+
+'''
+Compute the members to add and remove for a Databricks group
+members : all the users/group that should be in the final state of the group.This is retrieved from Azure AAD
+dbg : databricks group with id and membership
+directory : DatabricksDirectory index of all databricks users and groups
+trace : log the decision for every member at DEBUG, only meant for troubleshooting a single group
+Returns (toadd, toremove) where toadd are AAD members and toremove are Databricks members
+'''
+
+
+def compute_membership_diff(members, dbg, directory, trace=False):
+    desired = {}
+    for member in members:
+        desired.setdefault(member.key, member)
+
+    current = {}
+    for dbmember in dbg.get("members", []):
+        current.setdefault(db_member_key(dbmember, directory), dbmember)
+
+    toadd = [member for key, member in desired.items() if key not in current]
+    toremove = [dbmember for key, dbmember in current.items() if key not in desired]
+
+    if trace:
+        # The tracing loops only run when asked for, the diff itself never formats a member
+        name = dbg.get("displayName", dbg.get("id"))
+        for key in desired:
+            logging.debug("Group %s member %s %s: %s", name, key[0], key[1],
+                          "kept" if key in current else "to add")
+        for key in current:
+            if key not in desired:
+                logging.debug("Group %s member %s %s: to remove", name, key[0], key[1])
+
+    return toadd, toremove
+
+
+'''
+Name of a member in logs and summaries: user principal name or group display name of AAD members,
+display of Databricks members
+'''
+
+
+def member_label(member):
+    if isinstance(member, dict):
+        return member.get("display") or member.get("value")
+    if member.type == "user":
+        return member.user_principal_name
+    return member.display_name
+
+
+'''
+Structured summary of the membership change of one group: the number of members added and removed
+and the first sample_size principals of each
+'''
+
+
+def summarize_membership_diff(display_name, toadd, toremove, sample_size=DEFAULT_DIFF_SAMPLE_SIZE):
+    return {
+        "group": display_name,
+        "add": len(toadd),
+        "remove": len(toremove),
+        "sample_add": [member_label(member) for member in toadd[:sample_size]],
+        "sample_remove": [member_label(member) for member in toremove[:sample_size]]
+    }
+
+
+'''
+Log the diff summary of a group as one INFO record, the summary is also attached to the record as
+membership_diff for structured log handlers
+'''
+
+
+def log_membership_diff(summary):
+    if logging.root.isEnabledFor(logging.INFO):
+        logging.info("Membership diff %s", json.dumps(summary), extra={"membership_diff": summary})
+
+
+'''
+Resolve the Databricks ids of AAD members, members unknown to Databricks are skipped
+'''
+
+
+def resolve_member_ids(members, directory):
+    ids = []
+    for member in members:
+        if member.type == "user":
+            dbu = directory.get_user_by_name(member.user_principal_name)
+            if dbu is not None:
+                ids.append(dbu["id"])
+        elif member.type == "group":
+            dbgg = directory.get_group_by_name(member.display_name)
+            if dbgg is not None:
+                ids.append(dbgg["id"])
+    return ids
+
+
+'''
+Reference AAD members for a serialized plan: {"id": databricks id} for principals that exist in Databricks,
+{"ref": seq} for principals created by the plan operation seq.
+created : member key to the seq of the operation creating it. Members found in neither are skipped
+'''
+
+
+def resolve_member_references(members, directory, created):
+    references = []
+    for member in members:
+        if member.type == "user":
+            existing = directory.get_user_by_name(member.user_principal_name)
+        else:
+            existing = directory.get_group_by_name(member.display_name)
+
+        if existing is not None:
+            references.append({"id": existing["id"]})
+        elif member.key in created:
+            references.append({"ref": created[member.key]})
+    return references
+
+
+'''
+Build the PatchOp request bodies for a membership change.
+Every request carries at most max_ops member operations so large groups are split into several requests
+'''
+
+
+def build_patch_requests(add_ids, remove_ids, max_ops=DEFAULT_MAX_PATCH_OPS):
+    if max_ops < 1:
+        raise ValueError("max_ops must be at least 1")
+
+    values = [("add", i) for i in add_ids] + [("remove", i) for i in remove_ids]
+
+    requests = []
+    for start in range(0, len(values), max_ops):
+        ops = []
+        for op, member_id in values[start:start + max_ops]:
+            if not ops or ops[-1]["op"] != op:
+                ops.append({'op': op, 'path': "members", "value": []})
+            ops[-1]["value"].append({"value": member_id})
+        requests.append({"schemas": [PATCH_SCHEMA], "Operations": ops})
+
+    return requests
@@ -0,0 +1,118 @@
+from array import array
+
+'''
+Compact membership graph of the AAD hierarchy.
+Every user and group is interned once as a record with an integer id and the members of a group
+are kept as a sorted array of those ids, so a membership costs 8 bytes instead of a dictionary
+'''
+
+
+class UserRecord:
+    __slots__ = ("id", "display_name", "user_principal_name", "key")
+    type = "user"
+
+    def __init__(self, id, display_name, user_principal_name):
+        self.id = id
+        self.display_name = display_name
+        self.user_principal_name = user_principal_name
+        '''
+        Key matched against Databricks members by the diff engine, users are matched on user principal name
+        '''
+        self.key = ("user", user_principal_name.casefold())
+
+    def __repr__(self):
+        return f"UserRecord({self.display_name!r}, {self.user_principal_name!r})"
+
+
+class GroupRecord:
+    __slots__ = ("id", "display_name", "key")
+    type = "group"
+
+    def __init__(self, id, display_name):
+        self.id = id
+        self.display_name = display_name
+        '''
+        Key matched against Databricks members by the diff engine, groups are matched on display name
+        '''
+        self.key = ("group", display_name.casefold())
+
+    def __repr__(self):
+        return f"GroupRecord({self.display_name!r})"
+
+
+class MembershipGraph:
+
+    def __init__(self):
+        '''
+        Records indexed by their integer id
+        '''
+        self.records = []
+        self._user_ids = {}
+        self._group_ids = {}
+        '''
+        Group id to the sorted array of the distinct ids of its direct members
+        '''
+        self.members = {}
+
+    '''
+    Intern a user, the same (display name, user principal name) always gets the same id
+    '''
+
+    def user(self, display_name, user_principal_name):
+        key = (display_name, user_principal_name)
+        uid = self._user_ids.get(key)
+        if uid is None:
+            uid = self._user_ids[key] = len(self.records)
+            self.records.append(UserRecord(uid, display_name, user_principal_name))
+        return uid
+
+    '''
+    Intern a group by display name
+    '''
+
+    def group(self, display_name):
+        gid = self._group_ids.get(display_name)
+        if gid is None:
+            gid = self._group_ids[display_name] = len(self.records)
+            self.records.append(GroupRecord(gid, display_name))
+        return gid
+
+    '''
+    Add members to a group, adding all the members of a group at once is much cheaper than one at a time
+    '''
+
+    def add_members(self, group_name, member_ids):
+        gid = self.group(group_name)
+        ids = set(member_ids)
+        existing = self.members.get(gid)
+        if existing is not None:
+            ids.update(existing)
+        self.members[gid] = array("l", sorted(ids))
+
+    '''
+    Direct member records of a group, None when the group has no members
+    '''
+
+    def get(self, group_name, default=None):
+        gid = self._group_ids.get(group_name)
+        if gid is None or gid not in self.members:
+            return default
+        records = self.records
+        return [records[member_id] for member_id in self.members[gid]]
+
+    def __contains__(self, group_name):
+        gid = self._group_ids.get(group_name)
+        return gid is not None and gid in self.members
+
+    def __len__(self):
+        return len(self.members)
+
+    '''
+    Names of the groups with members
+    '''
+
+    def group_names(self):
+        return [self.records[gid].display_name for gid in self.members]
+
+    def edge_count(self):
+        return sum(len(members) for members in self.members.values())
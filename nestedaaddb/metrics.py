@@ -0,0 +1,166 @@
+import json
+import logging
+import os
+import time
+from collections import Counter
+from contextlib import contextmanager
+
+'''
+Run instrumentation: wall time per phase, request counts and latency histograms per endpoint,
+retry and throttle counts and the number of principals created, patched and deleted.
+A run report can be written as JSON or as a Prometheus textfile
+'''
+
+'''
+Upper bounds in seconds of the request latency histogram buckets
+'''
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+class EndpointStats:
+    __slots__ = ("count", "total_seconds", "buckets", "statuses")
+
+    def __init__(self):
+        self.count = 0
+        self.total_seconds = 0.0
+        self.buckets = [0] * len(LATENCY_BUCKETS)
+        self.statuses = Counter()
+
+    def observe(self, seconds, status):
+        self.count += 1
+        self.total_seconds += seconds
+        for i, bound in enumerate(LATENCY_BUCKETS):
+            if seconds <= bound:
+                self.buckets[i] += 1
+                break
+        if status is not None:
+            self.statuses[str(status)] += 1
+
+    '''
+    Cumulative bucket counts as expected by Prometheus
+    '''
+
+    def cumulative_buckets(self):
+        total = 0
+        cumulative = []
+        for count in self.buckets:
+            total += count
+            cumulative.append(total)
+        return cumulative
+
+    def to_dict(self):
+        return {
+            "count": self.count,
+            "total_seconds": round(self.total_seconds, 6),
+            "buckets": dict(zip([str(b) for b in LATENCY_BUCKETS], self.cumulative_buckets())),
+            "statuses": dict(self.statuses)
+        }
+
+
+'''
+info : descriptive fields of the run copied into the report, e.g. the top level group and dry run flag
+'''
+
+
+class RunMetrics:
+
+    def __init__(self, **info):
+        self.info = info
+        self.phases = {}
+        self.requests = {}
+        self.retries = Counter()
+        self.throttles = Counter()
+        self.principals = Counter()
+
+    '''
+    Time a phase of the run, phases run more than once accumulate
+    '''
+
+    @contextmanager
+    def phase(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            self.phases[name] = self.phases.get(name, 0.0) + elapsed
+            logging.info(f"Phase {name} took {elapsed:.3f}s")
+
+    '''
+    Record one request, service is graph or scim and endpoint a method and path template e.g. GET /Users.
+    status is the HTTP status, or "error" for a request that got no response such as a timeout
+    '''
+
+    def observe_request(self, service, endpoint, seconds, status=None):
+        key = (service, endpoint)
+        stats = self.requests.get(key)
+        if stats is None:
+            stats = self.requests[key] = EndpointStats()
+        stats.observe(seconds, status)
+
+    def record_retry(self, service):
+        self.retries[service] += 1
+
+    def record_throttle(self, service):
+        self.throttles[service] += 1
+
+    '''
+    Count principals changed by the run, e.g. users_created, groups_created, groups_patched, groups_deleted
+    '''
+
+    def count(self, action, n=1):
+        self.principals[action] += n
+
+    def report(self):
+        return {
+            "run": dict(self.info),
+            "phases": {name: round(seconds, 6) for name, seconds in self.phases.items()},
+            "requests": {f"{service} {endpoint}": stats.to_dict()
+                         for (service, endpoint), stats in sorted(self.requests.items())},
+            "retries": dict(self.retries),
+            "throttles": dict(self.throttles),
+            "principals": dict(self.principals)
+        }
+
+    def write_json(self, path):
+        _write_atomic(path, json.dumps(self.report(), indent=2))
+
+    '''
+    Write the metrics in the Prometheus text exposition format, for the node exporter textfile collector
+    '''
+
+    def write_prometheus(self, path, prefix="nestedaaddb"):
+        lines = [f"# TYPE {prefix}_phase_seconds gauge"]
+        for name, seconds in self.phases.items():
+            lines.append(f'{prefix}_phase_seconds{{phase="{name}"}} {seconds:.6f}')
+
+        lines.append(f"# TYPE {prefix}_requests_total counter")
+        for (service, endpoint), stats in sorted(self.requests.items()):
+            for status, count in sorted(stats.statuses.items()):
+                lines.append(f'{prefix}_requests_total{{service="{service}",endpoint="{endpoint}",status="{status}"}} '
+                             f'{count}')
+
+        lines.append(f"# TYPE {prefix}_request_duration_seconds histogram")
+        for (service, endpoint), stats in sorted(self.requests.items()):
+            labels = f'service="{service}",endpoint="{endpoint}"'
+            for bound, count in zip(LATENCY_BUCKETS, stats.cumulative_buckets()):
+                lines.append(f'{prefix}_request_duration_seconds_bucket{{{labels},le="{bound}"}} {count}')
+            lines.append(f'{prefix}_request_duration_seconds_bucket{{{labels},le="+Inf"}} {stats.count}')
+            lines.append(f'{prefix}_request_duration_seconds_sum{{{labels}}} {stats.total_seconds:.6f}')
+            lines.append(f'{prefix}_request_duration_seconds_count{{{labels}}} {stats.count}')
+
+        for metric, counter, label in (("retries_total", self.retries, "service"),
+                                       ("throttles_total", self.throttles, "service"),
+                                       ("principals_total", self.principals, "action")):
+            lines.append(f"# TYPE {prefix}_{metric} counter")
+            for key, count in sorted(counter.items()):
+                lines.append(f'{prefix}_{metric}{{{label}="{key}"}} {count}')
+
+        _write_atomic(path, "\n".join(lines) + "\n")
+
+
+def _write_atomic(path, content):
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as f:
+        f.write(content)
+    os.replace(tmp_path, path)
@@ -0,0 +1,175 @@
+import asyncio
+import json
+import logging
+import os
+
+from nestedaaddb.async_databricks_client import AsyncDatabricksClient
+from nestedaaddb.graph_client import Graph
+from nestedaaddb.metrics import RunMetrics
+from nestedaaddb.nested_groups import SyncNestedGroups
+from nestedaaddb.throttle import Governor
+
+'''
+Sync of one AAD resolution to many Databricks SCIM targets, e.g. several workspaces or accounts.
+The hierarchies are fetched from Graph once per run, every target is then planned against its own
+directory snapshot and applied concurrently with its own client, concurrency and rate limit
+'''
+
+
+class SyncTarget:
+    '''
+    name : label of the target in logs and reports
+    base_url, scim_token : SCIM endpoint and token of the target
+    max_concurrency : maximum number of concurrent SCIM requests to the target, defaults to DB_MAX_CONCURRENCY or 8
+    max_rps, burst : optional request rate limit of the target
+    '''
+
+    def __init__(self, name, base_url, scim_token, max_concurrency=None, max_rps=None, burst=None):
+        self.name = name
+        self.base_url = base_url
+        self.scim_token = scim_token
+        self.max_concurrency = max_concurrency
+        self.max_rps = max_rps
+        self.burst = burst
+
+    '''
+    Target from a configuration entry, the token is given by token or read from the environment variable token_env
+    '''
+
+    @classmethod
+    def from_dict(cls, config):
+        token = config.get("token")
+        if token is None and config.get("token_env"):
+            token = os.environ.get(config["token_env"])
+        if not token:
+            raise ValueError(f"No SCIM token for target {config.get('name')}, set token or token_env")
+        return cls(config["name"], config["base_url"], token, config.get("max_concurrency"),
+                   config.get("max_rps"), config.get("burst"))
+
+    def client(self):
+        return AsyncDatabricksClient(max_concurrency=self.max_concurrency,
+                                     governor=Governor("scim", rps=self.max_rps, burst=self.burst),
+                                     base_url=self.base_url, scim_token=self.scim_token)
+
+
+'''
+Load the targets of a JSON file holding a list of target configurations, see SyncTarget.from_dict
+'''
+
+
+def load_targets(path):
+    with open(path) as f:
+        targets = [SyncTarget.from_dict(config) for config in json.load(f)]
+
+    names = [target.name for target in targets]
+    if len(set(names)) != len(names):
+        raise ValueError(f"Duplicate target names in {path}")
+    return targets
+
+
+class MultiTargetSync:
+    '''
+    targets : list of SyncTarget
+    graph : optional preconfigured Graph wrapper shared by every target
+    metrics_json : optional path the combined report of every sync is written to as JSON
+    metrics_textfile : optional path the AAD metrics and the principals changed over all targets are written to
+    as a Prometheus textfile
+    The other arguments are the ones of SyncNestedGroups
+    '''
+
+    def __init__(self, targets, graph_concurrency=10, bulk_batch_size=100, bulk_fail_on_errors=None, graph=None,
+                 graph_traversal="recursive", metrics_json=None, metrics_textfile=None):
+        if not targets:
+            raise ValueError("At least one target is required")
+
+        self.graph = graph or Graph(max_concurrency=graph_concurrency, traversal=graph_traversal)
+        self.syncers = {
+            target.name: SyncNestedGroups(bulk_batch_size=bulk_batch_size, bulk_fail_on_errors=bulk_fail_on_errors,
+                                          graph=self.graph, dbclient=target.client())
+            for target in targets
+        }
+        self.metrics_json = metrics_json
+        self.metrics_textfile = metrics_textfile
+
+        '''
+        HierarchySnapshot of the last incremental sync_many, shared by every target
+        '''
+        self.snapshot = None
+
+    async def close(self):
+        await asyncio.gather(*[syncer.close() for syncer in self.syncers.values()])
+
+    '''
+    Resolve the hierarchies of the top level groups once and sync every target concurrently.
+    A failing target does not stop the others, its error is reported instead.
+    The incremental snapshot is only kept when every target succeeded without failed operations,
+    so a failed target catches up next time
+    Returns a report with the AAD phases and Graph requests, the principals changed over all targets
+    and the run report of every target
+    '''
+
+    async def sync_many(self, toplevelgroups, dryrun=False, consistency_check=False, incremental=False):
+        toplevelgroups = list(dict.fromkeys(toplevelgroups))
+        metrics = RunMetrics(toplevelgroups=toplevelgroups, dryrun=dryrun, targets=list(self.syncers))
+        self.graph.metrics = metrics
+
+        previous = self.snapshot if incremental else None
+        self.snapshot = None
+        resolver = next(iter(self.syncers.values()))
+
+        with metrics.phase("total"):
+            snapshot, changed = await resolver._resolve_snapshot(toplevelgroups, previous, incremental, metrics)
+
+            reports = {}
+            if changed:
+                roots = [toplevelgroup for toplevelgroup, _, _ in snapshot.roots]
+                desired = resolver._desired_state(snapshot)
+                if roots:
+                    names = list(self.syncers)
+                    results = await asyncio.gather(*[
+                        self._sync_target(name, roots, desired, dryrun, consistency_check) for name in names
+                    ])
+                    reports = dict(zip(names, results))
+            else:
+                logging.info("No AAD group changes since last run. Skipping sync.")
+
+        failed = [name for name, report in reports.items()
+                  if "error" in report or report.get("principals", {}).get("operations_failed")]
+        if incremental and not dryrun:
+            if failed:
+                logging.warning(f"Targets {', '.join(failed)} did not complete, the next run syncs in full")
+            else:
+                self.snapshot = snapshot
+
+        for target_report in reports.values():
+            for action, n in target_report.get("principals", {}).items():
+                metrics.count(action, n)
+        if self.metrics_textfile:
+            metrics.write_prometheus(self.metrics_textfile)
+
+        report = metrics.report()
+        report["targets"] = reports
+        if self.metrics_json:
+            tmp_path = self.metrics_json + ".tmp"
+            with open(tmp_path, "w") as f:
+                json.dump(report, f, indent=2)
+            os.replace(tmp_path, self.metrics_json)
+
+        return report
+
+    async def _sync_target(self, name, roots, desired, dryrun, consistency_check):
+        syncer = self.syncers[name]
+        metrics = RunMetrics(target=name, dryrun=dryrun)
+        syncer.dbclient.metrics = metrics
+
+        try:
+            with metrics.phase("total"):
+                await syncer._apply(roots, *desired, dryrun, consistency_check, metrics)
+        except Exception as e:
+            logging.exception(f"Sync of target {name} failed")
+            report = metrics.report()
+            report["error"] = f"{type(e).__name__}: {e}"
+            return report
+
+        logging.info(f"Target {name} synced: {dict(metrics.principals)}")
+        return metrics.report()
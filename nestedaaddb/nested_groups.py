@@ -1,145 +1,581 @@
+import asyncio
 import logging
-from nestedaaddb.graph_client import Graph
-from nestedaaddb.databricks_client import DatabricksClient
-from collections import defaultdict
+import os
+from nestedaaddb.graph_client import Graph, DeltaTokenExpiredError, build_hierarchy
+from nestedaaddb.async_databricks_client import AsyncDatabricksClient
+from nestedaaddb.databricks_directory import DatabricksDirectory
+from nestedaaddb.sync_state import SyncState, HierarchySnapshot
+from nestedaaddb.scim_bulk import BulkWriter
+from nestedaaddb.metrics import RunMetrics
+from nestedaaddb.membership_graph import MembershipGraph
+from nestedaaddb.membership_diff import log_membership_diff, DEFAULT_DIFF_SAMPLE_SIZE
+from nestedaaddb.parallel_diff import DiffSnapshot, compute_group_diffs
+from nestedaaddb.sync_plan import SyncPlan, Checkpoint
+from nestedaaddb.throttle import CircuitOpenError
 
 
 class SyncNestedGroups:
     '''
-    Dictionaries used for extracting and reusing user and group mappings(Including nestedAAD groups) in AAD
+    The user and group mappings(Including nestedAAD groups) in AAD are extracted for every run
+    and not kept between runs
     This utility requires the display name of databricks user exactly same as AAD name
     This is becuase Databricks Groups API gives display name and that is compared with AAD displayname in case of users
     If you have different display names in AAD vs Databricks,you can delete the user from databricks
     this program will recreate them
     '''
 
-    groupgp = defaultdict(set)
-    distinct_users = set()
-    distinct_groups = set()
-
     graph: Graph
-    dbclient: DatabricksClient
-
-    def __init__(self):
-        self.graph: Graph = Graph()
-        self.dbclient: DatabricksClient = DatabricksClient()
+    dbclient: AsyncDatabricksClient
 
     '''
-    Peforms sync of Users and Groups
+    graph_concurrency : maximum number of concurrent Graph requests while traversing the AAD hierarchy
+    db_concurrency : maximum number of concurrent Databricks SCIM requests, defaults to DB_MAX_CONCURRENCY or 8
+    bulk_batch_size : maximum number of creates sent in one SCIM /Bulk request
+    bulk_fail_on_errors : failOnErrors threshold of the /Bulk requests, None to process every operation
+    graph_traversal : hierarchy traversal engine of the Graph wrapper, recursive or transitive
+    graph : optional preconfigured Graph wrapper, graph_concurrency and graph_traversal are ignored when it is given
+    metrics_json : optional path the run report of every sync is written to as JSON
+    metrics_textfile : optional path the run report of every sync is written to as a Prometheus textfile
+    dbclient : optional preconfigured AsyncDatabricksClient, db_concurrency is ignored when it is given
+    trace_members : log every user and member compared by the plan at DEBUG, defaults to SYNC_TRACE_MEMBERS.
+    Without it the plan logs one summary per changed group
+    diff_sample_size : principals listed in the summary of each group, defaults to SYNC_DIFF_SAMPLE_SIZE or 5
+    diff_workers : processes computing the membership diffs of large runs, defaults to SYNC_DIFF_WORKERS or 1.
+    Runs with fewer than PARALLEL_DIFF_MIN_MEMBERS AAD memberships are always diffed in process. The workers are
+    started with forkserver or spawn, so scripts using them must guard their entry point with if __name__ == "__main__"
     '''
 
-    async def sync(self, toplevelgroup, dryrun=False):
+    def __init__(self, graph_concurrency=10, db_concurrency=None, bulk_batch_size=100, bulk_fail_on_errors=None,
+                 graph=None, metrics_json=None, metrics_textfile=None, graph_traversal="recursive", dbclient=None,
+                 trace_members=None, diff_sample_size=None, diff_workers=None):
+        self.graph: Graph = graph or Graph(max_concurrency=graph_concurrency, traversal=graph_traversal)
+        self.dbclient: AsyncDatabricksClient = dbclient or AsyncDatabricksClient(max_concurrency=db_concurrency)
+        self.bulk_writer = BulkWriter(self.dbclient, bulk_batch_size, bulk_fail_on_errors)
+        self.metrics_json = metrics_json
+        self.metrics_textfile = metrics_textfile
+        if trace_members is None:
+            trace_members = os.environ.get('SYNC_TRACE_MEMBERS', '').lower() in ('1', 'true', 'yes')
+        self.trace_members = trace_members
+        self.diff_sample_size = diff_sample_size if diff_sample_size is not None else \
+            int(os.environ.get('SYNC_DIFF_SAMPLE_SIZE', DEFAULT_DIFF_SAMPLE_SIZE))
+        self.diff_workers = diff_workers or int(os.environ.get('SYNC_DIFF_WORKERS', 1))
 
         '''
-        Read All Databricks users and groups
+        HierarchySnapshot of the last incremental sync_many, kept in memory between calls
         '''
-        dbusers = self.dbclient.get_dbusers()
-        dbgroups = self.dbclient.get_dbgroups()
+        self.snapshot = None
+
+    '''
+    Close the pooled Databricks connections
+    '''
+
+    async def close(self):
+        await self.dbclient.close()
+
+    '''
+    Peforms sync of Users and Groups
+    state_file : optional path of a JSON file enabling incremental sync.
+    The Graph groups delta link and the resolved hierarchy are saved there after each run where every operation
+    completed, later runs only refetch the groups that changed. When nothing changed in AAD the saved hierarchy
+    is still applied, so failed operations and changes made by hand in Databricks are reconciled.
+    An expired delta token falls back to a full resync. Dry runs never update the state file
+    consistency_check : re-read all Databricks users and groups after the creates instead of
+    updating the snapshot with the created resources
+    '''
+
+    async def sync(self, toplevelgroup, dryrun=False, state_file=None, consistency_check=False):
+        metrics = self._start_run(toplevelgroup=toplevelgroup, dryrun=dryrun)
+
+        with metrics.phase("total"):
+            await self._sync(toplevelgroup, dryrun, state_file, consistency_check, metrics)
+
+        return self._finish_run(metrics)
+
+    '''
+    Peforms sync of Users and Groups of many top level groups in one run.
+    The hierarchies are traversed once even where they overlap, their desired states are merged and
+    applied with a single Databricks snapshot, so every group is patched once with its combined membership.
+    Groups are only deleted when they are no longer under any of the top level groups
+    consistency_check : re-read Databricks after applying the changes and apply whatever difference is left
+    incremental : keep the resolved hierarchies in memory, the next call only refetches the groups changed since
+    according to the Graph groups delta and is skipped when nothing changed. Dry runs and runs where an operation
+    failed do not keep them, so the next call syncs in full
+    '''
+
+    async def sync_many(self, toplevelgroups, dryrun=False, consistency_check=False, incremental=False):
+        toplevelgroups = list(dict.fromkeys(toplevelgroups))
+        metrics = self._start_run(toplevelgroups=toplevelgroups, dryrun=dryrun)
+
+        with metrics.phase("total"):
+            await self._sync_many(toplevelgroups, dryrun, consistency_check, incremental, metrics)
+
+        return self._finish_run(metrics)
+
+    '''
+    Compute the diff plan of one or many top level groups, AAD and Databricks are read but nothing is changed
+    plan_file : optional path the plan is written to as JSON Lines, see nestedaaddb.sync_plan
+    Returns the SyncPlan
+    '''
+
+    async def plan(self, toplevelgroups, plan_file=None):
+        if isinstance(toplevelgroups, str):
+            toplevelgroups = [toplevelgroups]
+        toplevelgroups = list(dict.fromkeys(toplevelgroups))
+        metrics = self._start_run(toplevelgroups=toplevelgroups, dryrun=True)
+
+        with metrics.phase("total"):
+            roots, distinct_groupsU, distinct_usersU, entra_group_parent_map = await self._resolve_many(toplevelgroups,
+                                                                                                       metrics)
+            plan = SyncPlan(roots)
+            if roots:
+                plan = await self._plan(roots, distinct_groupsU, distinct_usersU, entra_group_parent_map, metrics)
+
+        if plan_file:
+            plan.write(plan_file)
+            logging.info(f"Plan written to {plan_file}")
+
+        self._finish_run(metrics)
+        return plan
+
+    '''
+    Apply a plan computed by plan, without reading AAD or the Databricks directory again
+    plan : SyncPlan or path of a plan file
+    checkpoint_file : optional path of the apply checkpoint, for a plan file it defaults to the plan path
+    with .checkpoint appended. Applying the same plan again skips the operations recorded in it,
+    so an interrupted apply or one with failed operations resumes where it stopped
+    workers : number of operations applied concurrently, defaults to the Databricks concurrency
+    Returns the run report
+    '''
+
+    async def apply(self, plan, checkpoint_file=None, workers=None):
+        if isinstance(plan, str):
+            checkpoint_file = checkpoint_file or plan + ".checkpoint"
+            plan = SyncPlan.load(plan)
+
+        metrics = self._start_run(toplevelgroups=plan.toplevelgroups, dryrun=False)
+        checkpoint = Checkpoint(checkpoint_file, plan)
+        try:
+            with metrics.phase("total"):
+                await self._apply_plan(plan, checkpoint, metrics, workers)
+        finally:
+            checkpoint.close()
+
+        logging.info("All Operation completed !")
+        return self._finish_run(metrics)
 
-        logging.info("1.All Databricks Users and group Read")
+    def _start_run(self, **info):
+        metrics = RunMetrics(**info)
+        self.graph.metrics = metrics
+        self.dbclient.metrics = metrics
+        return metrics
 
-        logging.info("1.1 Number of Users in databricks is :"+str(len(dbusers)))
-        logging.info("1.1 Number of groups in databricks is :" + str(len(dbgroups)))
+    def _finish_run(self, metrics):
+        if self.metrics_json:
+            metrics.write_json(self.metrics_json)
+        if self.metrics_textfile:
+            metrics.write_prometheus(self.metrics_textfile)
 
-        logging.info("2.Top level group requested is " + toplevelgroup)
+        return metrics.report()
+
+    '''
+    Look up a top level group in AAD, None when it does not exist or its name does not match
+    '''
+
+    async def _get_top_level_group(self, toplevelgroup):
+        logging.info("1.Top level group requested is " + toplevelgroup)
 
         group = await self.graph.get_group_by_name(toplevelgroup)
 
         if not (group and group.value):
             logging.warning(f"'{toplevelgroup}' not found. May be a user account, service principal or a non-existent group. Skipping sync.")
-            return
+            return None
 
-        logging.info("3.Top level group retrieved from AAD")
+        logging.info("2.Top level group retrieved from AAD")
 
-        '''
-        Indicates whether user and group collection are loaded successfully
-        '''
-        colInitialised = False
-
-        '''
-        Iterate through each group in AAD and map members corresponding to it including nested child group members
-        '''
         group = group.value[0]
         if toplevelgroup != "" and toplevelgroup.casefold() == group.display_name.casefold():
-            distinct_groupsU, distinct_usersU, entra_group_parent_map = await self.graph.extract_children_from_group(group.id,
-                                                                                                 group.display_name,
-                                                                                                 self.distinct_groups,
-                                                                                                 self.distinct_users,
-                                                                                                 self.groupgp)
-            colInitialised = True
+            return group
+        return None
+
+    async def _sync(self, toplevelgroup, dryrun, state_file, consistency_check, metrics):
+        desired = None
+
+        with metrics.phase("aad_hierarchy"):
+            state = None
+            if state_file:
+                state, changed = await self._refresh_state(toplevelgroup, state_file)
+                if state is not None and not changed:
+                    # Databricks is still read, it may differ after failed operations or changes made by hand
+                    logging.info("No AAD group changes since last run. Reconciling Databricks with the saved "
+                                 "hierarchy.")
+
+            if state is None:
+                group = await self._get_top_level_group(toplevelgroup)
+
+                '''
+                Iterate through each group in AAD and map members corresponding to it including nested child group members
+                The delta link is taken before the traversal so changes made during it are seen by the next run
+                '''
+                if group is not None:
+                    delta_link = await self.graph.get_latest_delta_link() if state_file else None
+                    adjacency = await self.graph.fetch_group_adjacency(group.id, group.display_name)
+                    state = SyncState(toplevelgroup, group.id, delta_link, adjacency)
+
+            if state is not None:
+                desired = build_hierarchy(state.root_id, state.adjacency, set(), set())
+
+        logging.info("3.Hierarchy analysed")
+
+        if desired is not None:
+            await self._apply([toplevelgroup], *desired, dryrun, consistency_check, metrics)
+
+            if state_file and not dryrun:
+                if metrics.principals["operations_failed"]:
+                    logging.warning(f"Sync state {state_file} not saved as some operations failed")
+                else:
+                    state.save(state_file)
+        logging.info("All Operation completed !")
+
+    async def _sync_many(self, toplevelgroups, dryrun, consistency_check, incremental, metrics):
+        previous = self.snapshot if incremental else None
+        self.snapshot = None
+
+        snapshot, changed = await self._resolve_snapshot(toplevelgroups, previous, incremental, metrics)
+        if not changed:
+            logging.info("No AAD group changes since last run. Skipping sync.")
+            self.snapshot = snapshot
+            return
+
+        roots = [toplevelgroup for toplevelgroup, _, _ in snapshot.roots]
+        desired = self._desired_state(snapshot)
+        if roots:
+            await self._apply(roots, *desired, dryrun, consistency_check, metrics)
+
+        if incremental and not dryrun:
+            if metrics.principals["operations_failed"]:
+                logging.warning("Some operations failed, the next run syncs in full")
+            else:
+                self.snapshot = snapshot
+        logging.info("All Operation completed !")
+
+    '''
+    Resolve the hierarchies of many top level groups into one desired state.
+    Returns (top level groups found in AAD, distinct groups, distinct users, membership graph)
+    '''
+
+    async def _resolve_many(self, toplevelgroups, metrics):
+        snapshot, _ = await self._resolve_snapshot(toplevelgroups, None, False, metrics)
+        return ([toplevelgroup for toplevelgroup, _, _ in snapshot.roots],) + self._desired_state(snapshot)
+
+    '''
+    Fetch the hierarchies of many top level groups.
+    Groups fetched for one top level group are reused by the next ones, so shared subtrees are fetched once.
+    previous : optional HierarchySnapshot of the same top level groups, only the groups changed since are refetched
+    track_changes : take a Graph groups delta link so the returned snapshot can be refreshed later
+    Returns (HierarchySnapshot, whether anything changed since previous)
+    '''
+
+    async def _resolve_snapshot(self, toplevelgroups, previous, track_changes, metrics):
+        with metrics.phase("aad_hierarchy"):
+            if previous is not None and previous.toplevelgroups == toplevelgroups:
+                try:
+                    changed_ids, delta_link = await self.graph.get_changed_group_ids(previous.delta_link)
+                except DeltaTokenExpiredError as e:
+                    logging.warning(f"{e}. Falling back to a full resync.")
+                    previous = None
+                else:
+                    if any(root_id in changed_ids for _, root_id, _ in previous.roots):
+                        logging.info("A top level group changed. Falling back to a full resync.")
+                        previous = None
+            else:
+                previous = None
+
+            if previous is not None:
+                invalidated = previous.invalidate(changed_ids)
+                previous.delta_link = delta_link
+                if not invalidated:
+                    return previous, False
+
+                logging.info(f"{invalidated} AAD groups changed since last run, refetching them")
+                roots = previous.roots
+                adjacency = previous.adjacency
+            else:
+                delta_link = await self.graph.get_latest_delta_link() if track_changes else None
+                roots = []
+                for toplevelgroup in toplevelgroups:
+                    group = await self._get_top_level_group(toplevelgroup)
+                    if group is not None:
+                        roots.append((toplevelgroup, group.id, group.display_name))
+                adjacency = {}
+
+            reachable = {}
+            for _, root_id, root_name in roots:
+                fetched = await self.graph.fetch_group_adjacency(root_id, root_name, adjacency)
+                adjacency.update(fetched)
+                reachable.update(fetched)
 
-        logging.info("4.Hierarchy analysed,going to create users and groups")
+        logging.info(f"3.Hierarchy analysed for {len(roots)} of {len(toplevelgroups)} top level groups")
+        return HierarchySnapshot(toplevelgroups, roots, delta_link, reachable), True
+
+    '''
+    Resolve the hierarchies of a snapshot into the same sets and membership graph, which merges their desired state.
+    Returns (distinct groups, distinct users, membership graph)
+    '''
+
+    def _desired_state(self, snapshot):
+        distinct_groupsU = set()
+        distinct_usersU = set()
+        entra_group_parent_map = MembershipGraph()
+        for _, root_id, _ in snapshot.roots:
+            build_hierarchy(root_id, snapshot.adjacency, distinct_groupsU, distinct_usersU, entra_group_parent_map)
+        return distinct_groupsU, distinct_usersU, entra_group_parent_map
+
+    '''
+    Bring Databricks to the desired state resolved from AAD: the diff is planned first, then applied.
+    A dry run only logs the plan.
+    With consistency_check Databricks is read again after the apply and whatever difference is left is applied
+    '''
+
+    async def _apply(self, toplevelgroups, distinct_groupsU, distinct_usersU, entra_group_parent_map, dryrun,
+                     consistency_check, metrics):
 
         if dryrun:
             logging.info("THIS IS DRY RUN.NO CHANGES WILL TAKE PLACE ON DATABRICKS")
 
-        if colInitialised:
+        plan = await self._plan(toplevelgroups, distinct_groupsU, distinct_usersU, entra_group_parent_map, metrics)
 
-            '''
-            Create Users and groups in Databricks as required
-            This is retrieved from AAD
-            
-            '''
+        if dryrun:
+            self._log_plan(plan, metrics)
+            return
 
-            # Loop through users and determine if they need to be created
-            for u in distinct_usersU:
-                exists = False
+        await self._apply_plan(plan, Checkpoint(None, plan), metrics)
+
+        '''
+        Reloading users from Databricks only when a consistency check is requested,
+        otherwise the plan already references the users and groups created by it
+        '''
+        if consistency_check:
+            with metrics.phase("databricks_reload"):
+                plan = await self._plan(toplevelgroups, distinct_groupsU, distinct_usersU, entra_group_parent_map,
+                                        metrics)
+            if plan.ops:
+                logging.warning(f"Consistency check found differences left after the apply: {plan.summary()}")
+                await self._apply_plan(plan, Checkpoint(None, plan), metrics)
+
+    '''
+    Compute the operations bringing Databricks to the desired state, Databricks is read but not changed.
+    toplevelgroups : top level groups the desired state was resolved from, groups nested under them
+    in Databricks but absent from the desired state are candidates for deletion
+    Returns the SyncPlan
+    '''
 
-                logging.debug("----0m----users identified to be present in groups selected")
-                logging.debug(f"User: {u}")
+    async def _plan(self, toplevelgroups, distinct_groupsU, distinct_usersU, entra_group_parent_map, metrics):
+        '''
+        Read All Databricks users and groups
+        '''
+        with metrics.phase("databricks_read"):
+            directory = await DatabricksDirectory.load(self.dbclient)
 
-                for udb in dbusers:
-                    if u[1].casefold() == udb["userName"].casefold():
-                        exists = True
+        logging.info("4.All Databricks Users and group Read,going to plan users and groups")
 
-                if not exists:
-                    self.dbclient.create_dbuser(u, dryrun)
+        logging.info("4.1 Number of Users in databricks is :"+str(len(directory.users_by_id)))
+        logging.info("4.1 Number of groups in databricks is :" + str(len(directory.groups_by_id)))
 
-            # Loop through groups and determine if they need to be created
-            for u in distinct_groupsU:
-                exists = False
+        plan = SyncPlan(toplevelgroups)
+        # Decided once, so the loops below cost a single boolean test per member when tracing is off
+        trace = self.trace_members and logging.root.isEnabledFor(logging.DEBUG)
 
-                for dbg in dbgroups:
-                    if u.casefold() == dbg.get("displayName", "").casefold():
-                        exists = True
+        with metrics.phase("plan"):
+            # Loop through users and groups and determine if they need to be created
+            # created : member key to the seq of the create, so later operations can reference the new principal
+            created = {}
+            for u in distinct_usersU:
+                if trace:
+                    logging.debug("User identified to be present in groups selected: %s", u)
 
-                if not exists:
-                    self.dbclient.create_blank_dbgroup(u, dryrun)
+                key = ("user", u[1].casefold())
+                if not directory.has_user(u[1]) and key not in created:
+                    created[key] = plan.create_user(u)
 
-            # Loop through groups nested under db parent sync groups and delete if they do not exist in Entra
-            dbgroups_within_parent = self.dbclient.get_distinct_nested_dbgroups(toplevelgroup)
-            for dbg in dbgroups_within_parent:
-                # If group is not in distinct groups then no longer within nested parent sync
-                if dbg[1] not in distinct_groupsU:
-                    # Check if group exists in Entra
-                    if not await self.graph.check_group_exists(dbg[1]):
-                        # If existing Entra group does not exist then it has been deleted - also remove from DBX
-                        logging.info(f"Deleting group: {dbg[1]}")
-                        if not dryrun:
-                            self.dbclient.delete_group(dbg[0], dryrun)
+            for u in distinct_groupsU:
+                key = ("group", u.casefold())
+                if not directory.has_group(u) and key not in created:
+                    created[key] = plan.create_group(u)
 
-            '''
-            Reloading users from Databricks as we need id of new users as well added in last step
-            '''
-            dbusers = self.dbclient.get_dbusers()
-            dbgroups = self.dbclient.get_dbgroups()
+            # Loop through groups nested under db parent sync groups and delete if they do not exist in Entra
+            dbgroups_within_parent = set()
+            for toplevelgroup in toplevelgroups:
+                dbgroups_within_parent.update(directory.get_distinct_nested_dbgroups(toplevelgroup))
+            # If group is not in distinct groups then no longer within nested parent sync
+            candidates = [dbg for dbg in dbgroups_within_parent if dbg[1] not in distinct_groupsU]
+            # Check if the candidates exist in Entra, all at once
+            exists = await self.graph.check_groups_exist([dbg[1] for dbg in candidates])
+            for dbg in candidates:
+                if not exists[dbg[1]]:
+                    # If existing Entra group does not exist then it has been deleted - also remove from DBX
+                    plan.delete_group(dbg[0], dbg[1])
 
             '''
-            Create groups or update membership of groups i.e. add/remove users from groups
+            Update membership of groups i.e. add/remove users from groups
             distinct_groupsU : distinct groups to be added as part of this operation
             we are comparing it with  databricks all groups to retrive gid
             which will be used to make databricks rest api calls
             '''
-            for u in distinct_groupsU:
-                exists = False
-                for dbg in dbgroups:
-                    if u.casefold() == dbg.get("displayName", "").casefold():
-                        exists = True
-                        # compare and add remove the members as needed
-                        # entra_group_parent_map : distinct users per group.This is retrieved from Azure AAD
-                        # we are getting all the users that should be in the final state of the group
-                        # dbg : databricks group with id
-                        # dbusers : all databricks users
-                        # dbgroups : all databricks groups
-                        self.dbclient.patch_dbgroup(dbg, entra_group_parent_map.get(u) or [], dbusers, dbgroups, dryrun)
-        logging.info("All Operation completed !")
\ No newline at end of file
+            with metrics.phase("diff"):
+                diffs = await compute_group_diffs(
+                    distinct_groupsU,
+                    DiffSnapshot(entra_group_parent_map, directory, created, self.diff_sample_size, trace),
+                    self.diff_workers)
+
+            for u, target, add, remove, summary in diffs:
+                log_membership_diff(summary)
+                plan.patch_group(u, target, add, remove)
+
+        logging.info(f"Plan: {plan.summary()}")
+        return plan
+
+    def _log_plan(self, plan, metrics):
+        for op in plan.ops:
+            if op["op"] == "create_user":
+                logging.info(f"User to be created {(op['displayName'], op['userName'])}")
+                metrics.count("users_created")
+            elif op["op"] == "create_group":
+                logging.info(f"Group to be created {op['displayName']}")
+                metrics.count("groups_created")
+            elif op["op"] == "delete_group":
+                logging.info(f"Deleting group: {op['displayName']}")
+                metrics.count("groups_deleted")
+            else:
+                # The membership change was already summarised when the plan was computed
+                metrics.count("groups_patched")
+
+    '''
+    Apply the operations of a plan not yet recorded in the checkpoint.
+    Creates are sent as SCIM /Bulk requests first, then deletes and membership updates are applied by
+    a pool of workers, the Databricks concurrency by default. Completed operations are recorded in the checkpoint as they finish,
+    failed operations are logged and left for the next apply
+    '''
+
+    async def _apply_plan(self, plan, checkpoint, metrics, workers=None):
+        pending = [op for op in plan.ops if op["seq"] not in checkpoint.done]
+
+        with metrics.phase("create"):
+            bulk_ops = {}
+            for op in pending:
+                if op["op"] == "create_user":
+                    bulk_ops[self.bulk_writer.add_user((op["displayName"], op["userName"]))] = op
+                elif op["op"] == "create_group":
+                    bulk_ops[self.bulk_writer.add_group(op["displayName"])] = op
+
+            # Each /Bulk request is checkpointed as it completes, so an interrupted apply keeps its creates
+            def record_created(batch_created):
+                for bulk_id, resource in batch_created.items():
+                    op = bulk_ops[bulk_id]
+                    checkpoint.record(op["seq"], resource["id"])
+                    metrics.count("users_created" if op["op"] == "create_user" else "groups_created")
+
+            created = await self.bulk_writer.flush(False, record_created)
+            failed = len(bulk_ops) - len(created)
+
+        with metrics.phase("delete"):
+            failed += await self._run_workers([op for op in pending if op["op"] == "delete_group"],
+                                              self._apply_delete, checkpoint, metrics, workers)
+
+        with metrics.phase("patch"):
+            failed += await self._run_workers([op for op in pending if op["op"] == "patch_group"],
+                                              self._apply_patch, checkpoint, metrics, workers)
+
+        if failed:
+            metrics.count("operations_failed", failed)
+            logging.error(f"{failed} plan operations did not complete, the next sync or apply of the plan retries them")
+
+    '''
+    Run the operations with a pool of workers, returns the number of operations that did not complete.
+    An open circuit stops every worker
+    '''
+
+    async def _run_workers(self, ops, handler, checkpoint, metrics, workers=None):
+        queue = list(reversed(ops))
+        failed = 0
+        stopped = []
+
+        async def worker():
+            nonlocal failed
+            while queue and not stopped:
+                op = queue.pop()
+                try:
+                    completed = await handler(op, checkpoint, metrics)
+                except CircuitOpenError as e:
+                    stopped.append(e)
+                    return
+                except Exception as e:
+                    logging.error(f"Operation {op['seq']} {op['op']} of {op['displayName']} failed: {e}")
+                    completed = False
+
+                if completed:
+                    checkpoint.record(op["seq"])
+                else:
+                    failed += 1
+
+        await asyncio.gather(*[worker() for _ in range(min(len(ops), workers or self.dbclient.maxConcurrency))])
+
+        if stopped:
+            raise stopped[0]
+        return failed
+
+    async def _apply_delete(self, op, checkpoint, metrics):
+        logging.info(f"Deleting group: {op['displayName']}")
+        await self.dbclient.delete_group(op["id"], False)
+        metrics.count("groups_deleted")
+        return True
+
+    '''
+    Returns False when the group or one of the added members was not created, the operation is then retried
+    by the next apply, adding members is idempotent
+    '''
+
+    async def _apply_patch(self, op, checkpoint, metrics):
+        gid = checkpoint.resolve(op["group"])
+        if gid is None:
+            logging.warning(f"Group {op['displayName']} was not created, not updating its membership")
+            return False
+
+        add_ids = [checkpoint.resolve(reference) for reference in op["add"]]
+        complete = None not in add_ids
+        if not complete:
+            logging.warning(f"Some members of {op['displayName']} were not created, adding the others")
+
+        await self.dbclient.patch_dbgroup_members(gid, [i for i in add_ids if i is not None], op["remove"])
+        metrics.count("groups_patched")
+        return complete
+
+    '''
+    Bring the saved incremental state up to date with the Graph groups delta.
+    Changed groups and their parents are dropped from the cached hierarchy and refetched.
+    Returns (state, changed), state is None when a full resync is required
+    '''
+
+    async def _refresh_state(self, toplevelgroup, state_file):
+        state = SyncState.load(state_file)
+        if state is None or state.toplevelgroup.casefold() != toplevelgroup.casefold():
+            return None, True
+
+        try:
+            changed_ids, delta_link = await self.graph.get_changed_group_ids(state.delta_link)
+        except DeltaTokenExpiredError as e:
+            logging.warning(f"{e}. Falling back to a full resync.")
+            return None, True
+
+        if state.root_id in changed_ids:
+            logging.info(f"Top level group '{toplevelgroup}' changed. Falling back to a full resync.")
+            return None, True
+
+        root_name = state.adjacency[state.root_id]["display_name"]
+        invalidated = state.invalidate(changed_ids)
+        state.delta_link = delta_link
+
+        if invalidated:
+            logging.info(f"{invalidated} AAD groups changed since last run, refetching them")
+            state.adjacency = await self.graph.fetch_group_adjacency(state.root_id, root_name, state.adjacency)
+
+        return state, invalidated > 0
@@ -0,0 +1,140 @@
+import asyncio
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+from nestedaaddb.membership_diff import compute_membership_diff, resolve_member_references, \
+    summarize_membership_diff, DEFAULT_DIFF_SAMPLE_SIZE
+
+'''
+Membership diff stage of the plan.
+The diff of every group only reads the AAD membership graph and the Databricks directory, so large runs
+split the groups into chunks diffed by a pool of processes. The snapshot is pickled once per worker when it
+starts, never per chunk. Workers are started with forkserver where available, otherwise spawn: by the time the
+diff runs the event loop has started threads, and forking a multi-threaded process can deadlock.
+Both paths return the same diffs in the same order, so the plan is identical to the serial one
+'''
+
+'''
+Smallest number of AAD memberships diffed by a process pool, smaller runs are diffed in the calling process
+where starting the workers would cost more than it saves
+'''
+PARALLEL_DIFF_MIN_MEMBERS = 100000
+
+'''
+Chunks per worker, several chunks per worker even out groups of very different sizes
+'''
+CHUNKS_PER_WORKER = 4
+
+
+class DiffSnapshot:
+    '''
+    entra_group_parent_map : MembershipGraph of the desired state
+    directory : DatabricksDirectory index of all databricks users and groups
+    created : member key to the seq of the plan operation creating it
+    sample_size : principals listed in the summary of each group
+    trace : log the decision for every member at DEBUG
+    '''
+
+    def __init__(self, entra_group_parent_map, directory, created, sample_size=DEFAULT_DIFF_SAMPLE_SIZE,
+                 trace=False):
+        self.entra_group_parent_map = entra_group_parent_map
+        self.directory = directory
+        self.created = created
+        self.sample_size = sample_size
+        self.trace = trace
+
+
+'''
+Diff the membership of one group.
+Returns (display name, patched group reference, add references, remove ids, summary),
+None when the membership is already up to date
+'''
+
+
+def diff_group(group, snapshot):
+    directory = snapshot.directory
+    dbg = directory.get_group_by_name(group)
+    if dbg is not None:
+        target = {"id": dbg["id"]}
+    else:
+        # Groups created by the plan have no members yet
+        target = {"ref": snapshot.created[("group", group.casefold())]}
+        dbg = {"members": []}
+
+    # entra_group_parent_map : distinct users per group.This is retrieved from Azure AAD
+    # we are getting all the users that should be in the final state of the group
+    toadd, toremove = compute_membership_diff(snapshot.entra_group_parent_map.get(group) or [], dbg, directory,
+                                              snapshot.trace)
+    if not toadd and not toremove:
+        return None
+
+    return (group, target, resolve_member_references(toadd, directory, snapshot.created),
+            [dbmember["value"] for dbmember in toremove],
+            summarize_membership_diff(group, toadd, toremove, snapshot.sample_size))
+
+
+'''
+Diff the membership of groups in the calling process, returns the diffs of the groups that changed in order
+'''
+
+
+def diff_groups(groups, snapshot):
+    diffs = []
+    for group in groups:
+        diff = diff_group(group, snapshot)
+        if diff is not None:
+            diffs.append(diff)
+    return diffs
+
+
+_worker_snapshot = None
+
+
+def _init_worker(snapshot):
+    global _worker_snapshot
+    _worker_snapshot = snapshot
+
+
+def _diff_chunk(groups):
+    return diff_groups(groups, _worker_snapshot)
+
+
+'''
+Diff the membership of groups with a pool of worker processes, returns the same diffs as diff_groups
+'''
+
+
+async def diff_groups_parallel(groups, snapshot, workers):
+    groups = list(groups)
+    chunk_size = max(1, -(-len(groups) // (workers * CHUNKS_PER_WORKER)))
+    chunks = [groups[i:i + chunk_size] for i in range(0, len(groups), chunk_size)]
+
+    if "forkserver" in multiprocessing.get_all_start_methods():
+        context = multiprocessing.get_context("forkserver")
+    else:
+        context = multiprocessing.get_context("spawn")
+
+    loop = asyncio.get_running_loop()
+    pool = ProcessPoolExecutor(max_workers=min(workers, len(chunks)) or 1, mp_context=context,
+                               initializer=_init_worker, initargs=(snapshot,))
+    try:
+        results = await asyncio.gather(*[loop.run_in_executor(pool, _diff_chunk, chunk) for chunk in chunks])
+    finally:
+        # Waiting for the workers to exit blocks, so it does not run on the event loop thread
+        await loop.run_in_executor(None, pool.shutdown)
+
+    return [diff for chunk in results for diff in chunk]
+
+
+'''
+Diff the membership of groups, with a pool of workers when there are enough memberships to be worth it.
+Member tracing always runs in the calling process so its records keep their order
+'''
+
+
+async def compute_group_diffs(groups, snapshot, workers=1):
+    groups = list(groups)
+    if workers > 1 and len(groups) > 1 and not snapshot.trace \
+            and snapshot.entra_group_parent_map.edge_count() >= PARALLEL_DIFF_MIN_MEMBERS:
+        return await diff_groups_parallel(groups, snapshot, workers)
+    return diff_groups(groups, snapshot)
@@ -0,0 +1,191 @@
+import asyncio
+import logging
+
+from nestedaaddb.databricks_client import user_payload, group_payload, is_conflict
+
+'''
+Statuses a SCIM service answers with when it does not implement the /Bulk endpoint
+'''
+BULK_UNSUPPORTED_STATUSES = {404, 405, 501}
+
+
+'''
+Collects pending user and group creates and sends them as SCIM /Bulk requests.
+batch_size : maximum number of operations in one /Bulk request
+fail_on_errors : failOnErrors sent with each request, None lets the service process every operation
+When the service does not support /Bulk the creates fall back to one POST per principal.
+A create rejected because the principal already exists resolves to the existing principal
+'''
+
+
+class BulkWriter:
+    batch_size: int
+    bulk_supported: bool
+
+    def __init__(self, dbclient, batch_size=100, fail_on_errors=None):
+        self.dbclient = dbclient
+        self.batch_size = batch_size
+        self.fail_on_errors = fail_on_errors
+        self.bulk_supported = True
+        self.pending = []
+
+    '''
+    Queue a user to be created, user is a (display name, user principal name) tuple.
+    Returns the bulkId of the operation
+    '''
+
+    def add_user(self, user):
+        bulk_id = f"user-{len(self.pending)}"
+        self.pending.append({"method": "POST", "path": "/Users", "bulkId": bulk_id,
+                             "data": user_payload(user), "item": user})
+        return bulk_id
+
+    '''
+    Queue a blank group to be created.
+    Returns the bulkId of the operation
+    '''
+
+    def add_group(self, group):
+        bulk_id = f"group-{len(self.pending)}"
+        self.pending.append({"method": "POST", "path": "/Groups", "bulkId": bulk_id,
+                             "data": group_payload(group), "item": group})
+        return bulk_id
+
+    '''
+    Send every queued create.
+    on_batch : optional function called with the bulkIds to resources of each request as soon as it completes
+    Returns a dictionary of bulkId to the created SCIM resource
+    '''
+
+    async def flush(self, dryrun, on_batch=None):
+        pending, self.pending = self.pending, []
+        created = {}
+
+        if dryrun:
+            for op in pending:
+                kind = "User" if op["path"] == "/Users" else "Group"
+                logging.info(f"{kind} to be created {op['item']}")
+            return created
+
+        async def send(batch):
+            result = await self._send_batch(batch)
+            if on_batch is not None:
+                on_batch(result)
+            return result
+
+        batches = [pending[i:i + self.batch_size] for i in range(0, len(pending), self.batch_size)]
+        results = await asyncio.gather(*[send(batch) for batch in batches])
+        for result in results:
+            created.update(result)
+
+        return created
+
+    async def _send_batch(self, batch):
+        if self.bulk_supported:
+            operations = [{k: op[k] for k in ("method", "path", "bulkId", "data")} for op in batch]
+            response = await self.dbclient.post_bulk(operations, self.fail_on_errors)
+
+            if response.status_code in BULK_UNSUPPORTED_STATUSES:
+                logging.info("SCIM /Bulk is not supported, falling back to one request per create")
+                self.bulk_supported = False
+            else:
+                created, conflicts = self._read_bulk_response(response, batch)
+                existing = await asyncio.gather(*[self._find_existing(op) for op in conflicts])
+                created.update({op["bulkId"]: resource for op, resource in zip(conflicts, existing)
+                                if resource is not None})
+                return created
+
+        resources = await asyncio.gather(*[self._create_one(op) for op in batch])
+        return {op["bulkId"]: {**op["data"], **resource} for op, resource in zip(batch, resources) if resource is not None}
+
+    async def _create_one(self, op):
+        if op["path"] == "/Users":
+            return await self.dbclient.create_dbuser(op["item"], False)
+        else:
+            return await self.dbclient.create_blank_dbgroup(op["item"], False)
+
+    '''
+    Existing principal of a create rejected because it already exists, None when it cannot be found
+    '''
+
+    async def _find_existing(self, op):
+        if op["path"] == "/Users":
+            resource = await self.dbclient.find_dbuser(op["data"]["userName"])
+        else:
+            resource = await self.dbclient.find_dbgroup(op["data"]["displayName"])
+        if resource is None:
+            logging.error(f"{op['item']} already exists but could not be found")
+        else:
+            logging.info(f"{op['item']} already exists, using {resource['id']}")
+        return resource
+
+    '''
+    Map the bulkIds of a /Bulk response to the created resources.
+    The id is read from the location of each operation, the resource is the operation response when the
+    service returns one, otherwise the request data with that id.
+    Operations answered without a known bulkId are matched to a request by the name of the returned resource,
+    otherwise they are skipped and the principals they were for count as not created.
+    Returns (bulkId to resource, operations of the batch rejected because the principal already exists)
+    '''
+
+    @staticmethod
+    def _read_bulk_response(response, batch):
+        ops = {op["bulkId"]: op for op in batch}
+        created = {}
+        conflicts = []
+        if response.status_code >= 400:
+            logging.error(f"SCIM /Bulk request failed with status {response.status_code}: {response.text}")
+            return created, conflicts
+
+        answered = set()
+        for op in response.json().get("Operations", []):
+            status = op.get("status", 0)
+            # RFC 7644 returns the status as a string, some services wrap it as {"code": ...}
+            if isinstance(status, dict):
+                status = status.get("code", 0)
+            status = int(status)
+
+            bulk_id = op.get("bulkId")
+            if bulk_id not in ops:
+                bulk_id = BulkWriter._correlate(op, ops, answered)
+                if bulk_id is None:
+                    logging.error(f"Ignoring bulk operation {op.get('method')} {op.get('location')} with status "
+                                  f"{status}, its bulkId {op.get('bulkId')} matches no request")
+                    continue
+            answered.add(bulk_id)
+
+            if is_conflict(status, op.get("response")):
+                conflicts.append(ops[bulk_id])
+            elif status >= 400:
+                logging.error(f"Bulk operation {bulk_id} failed with status {status}: {op.get('response')}")
+            elif op.get("location"):
+                resource_id = op["location"].rstrip("/").rsplit("/", 1)[-1]
+                if isinstance(op.get("response"), dict) and op["response"].get("id"):
+                    created[bulk_id] = op["response"]
+                else:
+                    created[bulk_id] = {**ops[bulk_id]["data"], "id": resource_id}
+                logging.info(f"Created {op['location']}")
+
+        for bulk_id in ops.keys() - answered:
+            logging.error(f"Bulk operation {bulk_id} got no result, {ops[bulk_id]['item']} was not created")
+
+        return created, conflicts
+
+    '''
+    bulkId of the unanswered request a bulk operation result is for, matched by the user name or display name
+    of the resource it returned. None when it returned none or no request matches
+    '''
+
+    @staticmethod
+    def _correlate(op, ops, answered):
+        resource = op.get("response")
+        if not isinstance(resource, dict):
+            return None
+
+        for bulk_id, request in ops.items():
+            if bulk_id in answered:
+                continue
+            field = "userName" if request["path"] == "/Users" else "displayName"
+            if str(resource.get(field, "")).casefold() == request["data"][field].casefold():
+                return bulk_id
+        return None
@@ -0,0 +1,163 @@
+import hashlib
+import json
+import logging
+import os
+from collections import Counter
+
+'''
+Serialized diff plan of a sync and the checkpoint of its apply.
+A plan is written as JSON Lines: a header line followed by one operation per line, each with a seq number
+create_user : {"seq", "op", "displayName", "userName"}
+create_group : {"seq", "op", "displayName"}
+delete_group : {"seq", "op", "id", "displayName"}
+patch_group : {"seq", "op", "displayName", "group", "add", "remove"}
+The patched group and the added members are {"id": databricks id} for principals that already exist
+or {"ref": seq} for principals created by an earlier operation of the same plan.
+remove holds the databricks ids of the members to remove
+'''
+
+PLAN_VERSION = 1
+
+CREATE_OPS = ("create_user", "create_group")
+
+
+class SyncPlan:
+
+    def __init__(self, toplevelgroups, ops=None):
+        self.toplevelgroups = list(toplevelgroups)
+        self.ops = ops if ops is not None else []
+
+    def _add(self, op, **fields):
+        entry = {"seq": len(self.ops), "op": op, **fields}
+        self.ops.append(entry)
+        return entry["seq"]
+
+    '''
+    Each add method returns the seq of the operation, used to reference a created principal
+    '''
+
+    def create_user(self, user):
+        return self._add("create_user", displayName=user[0], userName=user[1])
+
+    def create_group(self, group):
+        return self._add("create_group", displayName=group)
+
+    def delete_group(self, gid, display_name):
+        return self._add("delete_group", id=gid, displayName=display_name)
+
+    def patch_group(self, display_name, group, add, remove):
+        return self._add("patch_group", displayName=display_name, group=group, add=add, remove=remove)
+
+    def summary(self):
+        return dict(Counter(op["op"] for op in self.ops))
+
+    '''
+    Digest of the operations, a checkpoint is only valid for the plan it was written for
+    '''
+
+    def digest(self):
+        sha = hashlib.sha256()
+        for op in self.ops:
+            sha.update(json.dumps(op, sort_keys=True).encode())
+        return sha.hexdigest()
+
+    def write(self, path):
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w") as f:
+            f.write(json.dumps({"version": PLAN_VERSION, "toplevelgroups": self.toplevelgroups,
+                                "summary": self.summary()}) + "\n")
+            for op in self.ops:
+                f.write(json.dumps(op) + "\n")
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        with open(path) as f:
+            header = json.loads(f.readline())
+            if header.get("version") != PLAN_VERSION:
+                raise ValueError(f"Unsupported plan version {header.get('version')} in {path}")
+            ops = [json.loads(line) for line in f if line.strip()]
+        return cls(header["toplevelgroups"], ops)
+
+
+'''
+Append-only record of the operations of a plan that completed.
+Every completed operation is one JSON line, created principals carry their databricks id,
+so an interrupted apply resumes with the remaining operations only.
+A truncated last line left by a crash is ignored.
+read_only : only load the operations already applied, e.g. to inspect the progress of an apply
+'''
+
+
+class Checkpoint:
+
+    def __init__(self, path, plan, read_only=False):
+        self.path = path
+        self.done = set()
+        self.created = {}
+
+        digest = plan.digest()
+        content = ""
+        if path and os.path.exists(path):
+            with open(path) as f:
+                content = f.read()
+
+        # A file without a complete header line was cut short before any operation was recorded, it starts over
+        if "\n" in content:
+            lines = content.splitlines()
+            try:
+                header = json.loads(lines[0]) if lines else {}
+            except ValueError:
+                header = {}
+            if header.get("plan") != digest:
+                raise ValueError(f"Checkpoint {path} was written for another plan")
+
+            for line in lines[1:]:
+                if not line:
+                    continue
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    logging.warning(f"Ignoring truncated checkpoint entry in {path}")
+                    continue
+                self.done.add(entry["seq"])
+                if entry.get("id") is not None:
+                    self.created[entry["seq"]] = entry["id"]
+
+            if read_only:
+                self._file = None
+                return
+            logging.info(f"Resuming plan from checkpoint {path}, {len(self.done)} operations already applied")
+            self._file = open(path, "a")
+            if not content.endswith("\n"):
+                # Ends the entry truncated by a crash, the next entry would be appended to it otherwise
+                self._file.write("\n")
+                self._file.flush()
+        elif path and not read_only:
+            self._file = open(path, "w")
+            self._file.write(json.dumps({"plan": digest}) + "\n")
+            self._file.flush()
+        else:
+            self._file = None
+
+    def record(self, seq, created_id=None):
+        self.done.add(seq)
+        if created_id is not None:
+            self.created[seq] = created_id
+        if self._file is not None:
+            self._file.write(json.dumps({"seq": seq, "id": created_id}) + "\n")
+            self._file.flush()
+
+    '''
+    Databricks id of a member reference, None when it refers to a principal that was not created
+    '''
+
+    def resolve(self, reference):
+        if "id" in reference:
+            return reference["id"]
+        return self.created.get(reference["ref"])
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
@@ -0,0 +1,104 @@
+import json
+import logging
+import os
+
+'''
+State persisted between incremental sync runs.
+It holds the Graph groups delta link and the direct membership of every group of the last resolved hierarchy
+as returned by Graph.fetch_group_adjacency
+'''
+
+
+class SyncState:
+    toplevelgroup: str
+    root_id: str
+    delta_link: str
+    adjacency: dict
+
+    def __init__(self, toplevelgroup, root_id, delta_link, adjacency):
+        self.toplevelgroup = toplevelgroup
+        self.root_id = root_id
+        self.delta_link = delta_link
+        self.adjacency = adjacency
+
+    '''
+    Load the state from a JSON file, None when there is no usable state
+    '''
+
+    @classmethod
+    def load(cls, path):
+        if not os.path.exists(path):
+            return None
+
+        try:
+            with open(path) as f:
+                data = json.load(f)
+            return cls(data["toplevelgroup"], data["root_id"], data["delta_link"], data["adjacency"])
+        except (ValueError, KeyError) as e:
+            logging.warning(f"Ignoring unreadable sync state {path}: {e}")
+            return None
+
+    '''
+    Save the state to a JSON file.
+    The file is replaced atomically so an interrupted run never leaves a truncated state behind
+    '''
+
+    def save(self, path):
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({
+                "toplevelgroup": self.toplevelgroup,
+                "root_id": self.root_id,
+                "delta_link": self.delta_link,
+                "adjacency": self.adjacency
+            }, f)
+        os.replace(tmp_path, path)
+
+    '''
+    Drop the changed groups, and the groups listing them as members, from the cached membership.
+    Returns the number of cached groups that were invalidated
+    '''
+
+    def invalidate(self, changed_ids):
+        return invalidate_adjacency(self.adjacency, changed_ids)
+
+
+'''
+Hierarchies of many top level groups resolved by the last run, kept in memory by long running processes.
+roots : list of (top level group, group id, display name) found in AAD
+adjacency : direct membership of every group reachable from the roots as returned by Graph.fetch_group_adjacency
+'''
+
+
+class HierarchySnapshot:
+    toplevelgroups: list
+    roots: list
+    delta_link: str
+    adjacency: dict
+
+    def __init__(self, toplevelgroups, roots, delta_link, adjacency):
+        self.toplevelgroups = toplevelgroups
+        self.roots = roots
+        self.delta_link = delta_link
+        self.adjacency = adjacency
+
+    def invalidate(self, changed_ids):
+        return invalidate_adjacency(self.adjacency, changed_ids)
+
+
+'''
+Drop the changed groups, and the groups listing them as members, from a cached membership.
+Returns the number of cached groups that were invalidated
+'''
+
+
+def invalidate_adjacency(adjacency, changed_ids):
+    affected = {gid for gid in changed_ids if gid in adjacency}
+    for gid, entry in adjacency.items():
+        if any(child_id in changed_ids for child_id, _ in entry["groups"]):
+            affected.add(gid)
+
+    for gid in affected:
+        del adjacency[gid]
+
+    return len(affected)
@@ -0,0 +1,310 @@
+import asyncio
+import logging
+import os
+import random
+import threading
+import time
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+
+'''
+Rate governor shared by the Graph and Databricks clients.
+Every service gets one governor for the whole process: a token bucket limiting the request rate,
+retries of throttled and failed requests with jittered exponential backoff honouring Retry-After,
+and a circuit breaker that stops sending requests to a service that keeps failing
+'''
+
+'''
+Statuses retried by the governor, 429 pauses every caller of the service for the Retry-After delay
+'''
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+'''
+Environment variable prefix of the settings of each service, e.g. DB_MAX_RPS or GRAPH_BURST
+'''
+SERVICE_ENV_PREFIXES = {"graph": "GRAPH", "scim": "DB"}
+
+
+class CircuitOpenError(Exception):
+    pass
+
+
+class TokenBucket:
+    '''
+    rate : requests per second, 0 or None for no limit
+    burst : number of requests that can be sent at once after an idle period
+    '''
+
+    def __init__(self, rate=None, burst=None):
+        self.rate = rate or 0
+        self.burst = max(1, burst or int(self.rate) or 1)
+        self.tokens = float(self.burst)
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self.lock = threading.Lock()
+
+    '''
+    Take a token and return how long the caller has to wait before sending its request.
+    Tokens are reserved ahead so concurrent callers are spaced out instead of all waking up together
+    '''
+
+    def reserve(self):
+        with self.lock:
+            now = time.monotonic()
+            wait = max(0.0, self.paused_until - now)
+            if self.rate:
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                self.tokens -= 1
+                if self.tokens < 0:
+                    wait = max(wait, -self.tokens / self.rate)
+            return wait
+
+    '''
+    Hold every request for the given number of seconds, used when the service asks to back off
+    '''
+
+    def pause(self, seconds):
+        with self.lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+
+class CircuitBreaker:
+    '''
+    failure_threshold : consecutive failures after which the circuit opens
+    reset_timeout : seconds the circuit stays open before a request is let through again
+    '''
+
+    def __init__(self, failure_threshold=10, reset_timeout=30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self.lock = threading.Lock()
+
+    def check(self, service):
+        with self.lock:
+            if self.opened_at is None:
+                return
+            remaining = self.opened_at + self.reset_timeout - time.monotonic()
+            if remaining > 0:
+                raise CircuitOpenError(f"Circuit open for {service} after {self.failures} consecutive failures, "
+                                       f"retry in {remaining:.1f}s")
+
+    def record_success(self):
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+
+    '''
+    Returns True when this failure opened the circuit
+    '''
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            # A failed trial request after the reset timeout reopens the circuit straight away
+            if self.failures >= self.failure_threshold:
+                was_closed = self.opened_at is None
+                self.opened_at = time.monotonic()
+                return was_closed
+            return False
+
+
+class Governor:
+    '''
+    service : service name used in logs and metrics, graph or scim
+    rps : requests per second, None for no limit
+    burst : requests allowed at once, defaults to rps
+    max_retries : retries of a throttled or failed request before its last response is returned
+    base_delay, max_delay : bounds in seconds of the exponential backoff
+    failure_threshold, reset_timeout : circuit breaker settings
+    '''
+
+    def __init__(self, service, rps=None, burst=None, max_retries=5, base_delay=0.5, max_delay=60.0,
+                 failure_threshold=10, reset_timeout=30.0):
+        self.service = service
+        self.bucket = TokenBucket(rps, burst)
+        self.breaker = CircuitBreaker(failure_threshold, reset_timeout)
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    '''
+    Delay before retry number attempt, full jitter on the exponential backoff but never less than Retry-After
+    '''
+
+    def backoff(self, attempt, retry_after=None):
+        delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+        if retry_after is not None:
+            delay = max(delay, retry_after)
+        return delay
+
+    '''
+    Send a request through the governor from a coroutine.
+    send : function returning an awaitable of the response, called again for every attempt
+    metrics : optional RunMetrics receiving the retries and throttles
+    idempotent : False for requests that must not be applied twice, such as creates. They are only retried
+    when the service did not process them: 429, or 503 with Retry-After
+    Returns the response, which may still be an error once the retries are exhausted.
+    Errors carrying a response_status_code (Graph APIError) are retried like responses and raised at the end,
+    other errors such as connection failures and timeouts count as failures of the service and are raised
+    '''
+
+    async def call(self, send, metrics=None, idempotent=True):
+        attempt = 0
+        while True:
+            self.breaker.check(self.service)
+            wait = self.bucket.reserve()
+            if wait:
+                await asyncio.sleep(wait)
+
+            try:
+                result = await send()
+                error = None
+            except Exception as e:
+                if getattr(e, "response_status_code", None) is None:
+                    self._record_failure()
+                    raise
+                result, error = e, e
+
+            delay = self._outcome(result, attempt, metrics, idempotent)
+            if delay is None:
+                if error is not None:
+                    raise error
+                return result
+
+            await asyncio.sleep(delay)
+            attempt += 1
+
+    '''
+    Blocking counterpart of call for the requests based client
+    '''
+
+    def call_blocking(self, send, metrics=None, idempotent=True):
+        attempt = 0
+        while True:
+            self.breaker.check(self.service)
+            wait = self.bucket.reserve()
+            if wait:
+                time.sleep(wait)
+
+            try:
+                result = send()
+            except Exception:
+                self._record_failure()
+                raise
+
+            delay = self._outcome(result, attempt, metrics, idempotent)
+            if delay is None:
+                return result
+
+            time.sleep(delay)
+            attempt += 1
+
+    def _record_failure(self):
+        if self.breaker.record_failure():
+            logging.error(f"Too many consecutive {self.service} failures, pausing requests for "
+                          f"{self.breaker.reset_timeout}s")
+
+    '''
+    Record the outcome of an attempt and return the delay before retrying it, None when it is final
+    '''
+
+    def _outcome(self, result, attempt, metrics, idempotent=True):
+        status = _status_of(result)
+        if status not in RETRY_STATUSES:
+            self.breaker.record_success()
+            return None
+
+        retry_after = _retry_after_of(result)
+        if status == 429:
+            if metrics is not None:
+                metrics.record_throttle(self.service)
+            if retry_after is not None:
+                self.bucket.pause(retry_after)
+        else:
+            self._record_failure()
+
+        # Other server errors may come after the service applied the request, retrying would apply it twice
+        if not idempotent and status != 429 and not (status == 503 and retry_after is not None):
+            logging.warning(f"{self.service} request answered {status}, not retried as it may have been applied")
+            return None
+
+        if attempt >= self.max_retries:
+            logging.error(f"{self.service} request still failing with status {status} after {attempt} retries")
+            return None
+
+        delay = self.backoff(attempt, retry_after)
+        logging.warning(f"{self.service} request answered {status}, retrying in {delay:.2f}s")
+        if metrics is not None:
+            metrics.record_retry(self.service)
+        return delay
+
+
+def _status_of(result):
+    status = getattr(result, "status_code", None)
+    if status is None:
+        status = getattr(result, "response_status_code", None)
+    return status
+
+
+'''
+Retry-After of a response or Graph error in seconds, given either as a number of seconds or an HTTP date
+'''
+
+
+def _retry_after_of(result):
+    headers = getattr(result, "headers", None)
+    if headers is None:
+        headers = getattr(result, "response_headers", None)
+    if not headers:
+        return None
+
+    return parse_retry_after(headers.get("Retry-After") or headers.get("retry-after"))
+
+
+'''
+Seconds of a Retry-After header value, a number of seconds or an HTTP date. None when it is missing or invalid
+'''
+
+
+def parse_retry_after(value):
+    if isinstance(value, (list, tuple, set)):
+        value = next(iter(value), None)
+    if value is None:
+        return None
+
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, (parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds())
+    except (TypeError, ValueError):
+        return None
+
+
+_governors = {}
+_governors_lock = threading.Lock()
+
+'''
+Get the governor shared by every client of a service, created on first use from the environment:
+<PREFIX>_MAX_RPS, <PREFIX>_BURST and <PREFIX>_MAX_RETRIES with the prefixes of SERVICE_ENV_PREFIXES
+'''
+
+
+def get_governor(service):
+    with _governors_lock:
+        governor = _governors.get(service)
+        if governor is None:
+            prefix = SERVICE_ENV_PREFIXES.get(service, service.upper())
+            rps = os.environ.get(f"{prefix}_MAX_RPS")
+            burst = os.environ.get(f"{prefix}_BURST")
+            governor = _governors[service] = Governor(
+                service,
+                rps=float(rps) if rps else None,
+                burst=int(burst) if burst else None,
+                max_retries=int(os.environ.get(f"{prefix}_MAX_RETRIES", 5))
+            )
+        return governor